@@ -1,31 +1,84 @@
-from fastapi import FastAPI, HTTPException, Body, File, UploadFile, Path
+from fastapi import FastAPI, HTTPException, Body, File, UploadFile, Path, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response
+import asyncio
 import os
 import base64
+import hashlib
 import tempfile
 from pydantic import BaseModel
 from typing import Dict, Any, Optional
 import uuid
-from datetime import datetime
+from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
 from dotenv import load_dotenv
-#only chnage this line to use the enhanced model
-from qwenmodel_sequential_enhanced import (
-                inference_sequential,
-                pdf_to_base64_images as pdf_to_base64_images_seq,
-            )
-from summary import (
-                inference as summary_inference,
-                pdf_to_base64_images as summary_pdf_to_base64_images,
-            )
+# The inference modules (model client, pdf2image/PIL) are imported inside
+# the endpoints on first use, so the app and its workers start quickly
 import traceback
 from config import logger
+import metrics
+from llm_backend import get_pool
+import schema_registry
+import catalog
+import warmup
+import temp_janitor
+import uploads
+import page_images
+import preprocess
+import scheduler
 
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # Load the models in the background: the server starts answering at once
+    # and /ready reports when the models are loaded
+    warmup_task = asyncio.create_task(warmup.wait_until_ready())
+    keep_warm_task = asyncio.create_task(warmup.keep_warm_loop())
+    # Removes expired and orphaned temp PDFs, starting with a sweep now
+    janitor_task = asyncio.create_task(temp_janitor.janitor_loop())
+    # Upload-time pre-processing (PREPROCESS_ON_UPLOAD=on)
+    preprocess_tasks = preprocess.start()
+    yield
+    for task in preprocess_tasks:
+        task.cancel()
+    janitor_task.cancel()
+    keep_warm_task.cancel()
+    warmup_task.cancel()
+
+app = FastAPI(lifespan=lifespan)
+
+class UploadSizeLimit:
+    """
+    Answer 413 to an /upload whose Content-Length is over UPLOAD_MAX_MB
+    before any of its body is read: FastAPI parses (and spools) the whole
+    multipart form before the endpoint runs. Uploads without a
+    Content-Length are capped while they are copied into the blob store.
+    """
+
+    # Multipart boundaries and part headers around the file
+    FORM_OVERHEAD_BYTES = 64 * 1024
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == "/upload":
+            content_length = dict(scope["headers"]).get(b"content-length", b"")
+            max_bytes = uploads.max_upload_bytes()
+            if content_length.isdigit() and int(content_length) > max_bytes + self.FORM_OVERHEAD_BYTES:
+                metrics.incr("uploads_rejected_total", reason="content_length")
+                response = JSONResponse(
+                    status_code=413, content={"detail": f"File exceeds the maximum upload size of {max_bytes} bytes"},
+                    headers={"Connection": "close"},
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+app.add_middleware(UploadSizeLimit)
 
 app.add_middleware(
     CORSMiddleware,
@@ -37,17 +90,62 @@ app.add_middleware(
 
 class ProcessPdfRequest(BaseModel):
     pdfData: str  # Base64 encoded PDF
+    formSchema: Optional[Dict[str, Any]] = None
+    schemaId: Optional[str] = None  # From POST /schemas, instead of repeating formSchema
+    summaryMode: Optional[str] = None  # "cumulative", "tree" or "delta"; defaults to SUMMARY_MODE
+    documentId: Optional[str] = None  # From /upload; results are indexed for /search under this document
+    priority: Optional[str] = None  # "interactive" (default), "batch" or "background": model call scheduling class
+
+class RegisterSchemaRequest(BaseModel):
     formSchema: Dict[str, Any]
 
-# In-memory storage for file metadata (replaces database)
-file_storage = {}
+def apply_priority(request: ProcessPdfRequest):
+    """Schedule this request's model calls at its priority class"""
+    try:
+        scheduler.set_priority(request.priority)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-# In-memory storage for temporary files (for summarization)
-temp_file_storage = {}
+def resolve_form_schema(request: ProcessPdfRequest):
+    """Return the CompiledSchema for a request carrying either schemaId or formSchema"""
+    if request.schemaId:
+        compiled = schema_registry.get_schema(request.schemaId)
+        if compiled is None:
+            raise HTTPException(status_code=404, detail=f"Unknown schemaId {request.schemaId}; register the schema again")
+        return compiled
+    if request.formSchema:
+        return schema_registry.compile_schema(request.formSchema)
+    raise HTTPException(status_code=400, detail="Either formSchema or schemaId is required")
+
+def index_for_search(request: ProcessPdfRequest, pdf_bytes: bytes, extracted=None, summary=None):
+    """
+    Add extraction/summary results to the search index of the catalogued
+    document: the request's documentId, else uploads with the same content.
+    Indexing problems are logged and never fail the request. Blocking (a
+    catalog write transaction): handlers run it in a worker thread.
+    """
+    try:
+        if request.documentId:
+            doc_ids = [request.documentId] if catalog.get_document(request.documentId) else []
+        else:
+            doc_ids = [doc["doc_id"] for doc in catalog.find_by_hash(hashlib.sha256(pdf_bytes).hexdigest())]
+        if not doc_ids:
+            return
+        with catalog.transaction():
+            if extracted:
+                catalog.index_extraction(doc_ids, extracted)
+            if summary:
+                catalog.index_summary(doc_ids, summary)
+    except Exception as e:
+        logger.warning(f"Could not index results for search: {e}")
 
 @app.post("/process-pdf")
 async def process_pdf_sequential(request: ProcessPdfRequest):
     """Process PDF using sequential page-by-page approach with context carryover"""
+    #only chnage this line to use the enhanced model
+    from qwenmodel_sequential_enhanced import inference_sequential
+
+    apply_priority(request)
     try:
         # Decode base64 PDF data
         try:
@@ -55,6 +153,22 @@ async def process_pdf_sequential(request: ProcessPdfRequest):
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Invalid base64 PDF data: {str(e)}")
 
+        compiled_schema = await asyncio.to_thread(resolve_form_schema, request)
+
+        # Pre-processed at upload time against this schema: nothing left to do
+        pdf_sha256 = hashlib.sha256(pdf_data).hexdigest()
+        cached = await asyncio.to_thread(preprocess.cached_extraction, pdf_sha256, compiled_schema.schema_id)
+        if cached is not None:
+            logger.info(f"[SEQUENTIAL] Using the extraction pre-processed at upload ({cached['pages']} pages)")
+            return {
+                "message": "PDF processed successfully with sequential context",
+                "pages_processed": cached["pages"],
+                "processing_method": "sequential_with_context",
+                "fields_extracted": len(cached["fields"]),
+                "success": True,
+                **cached["fields"]
+            }
+
         # Create temporary file
         temp_filename = f"temp_pdf_{uuid.uuid4().hex[:12]}.pdf"
         temp_path = os.path.join(tempfile.gettempdir(), temp_filename)
@@ -66,8 +180,9 @@ async def process_pdf_sequential(request: ProcessPdfRequest):
             raise HTTPException(status_code=500, detail=f"Failed to save PDF: {str(e)}")
 
         try:
-            # Convert PDF to base64 images
-            base64_images = pdf_to_base64_images_seq(temp_path)
+            # Convert PDF to base64 images (cached for uploaded content, maybe rendered at upload);
+            # rendering and inference block, so they run off the event loop
+            base64_images = await asyncio.to_thread(preprocess.model_page_images, temp_path, pdf_sha256)
             if not base64_images:
                 raise HTTPException(
                     status_code=500, detail="PDF is empty or no images could be extracted."
@@ -76,7 +191,9 @@ async def process_pdf_sequential(request: ProcessPdfRequest):
             # Process sequentially with context carryover
             logger.info(f"[SEQUENTIAL] Processing {len(base64_images)} pages with context carryover")
             
-            extracted_data = inference_sequential(base64_images, request.formSchema)
+            page_texts = await asyncio.to_thread(preprocess.text_pages, temp_path, pdf_sha256)
+            extracted_data = await asyncio.to_thread(inference_sequential, base64_images, compiled_schema, page_texts=page_texts)
+            await asyncio.to_thread(index_for_search, request, pdf_data, extracted=extracted_data)
             
             # Clean up temporary file
             try:
@@ -117,6 +234,11 @@ async def summarize_pdf_direct(request: ProcessPdfRequest):
     """
     Directly summarize PDF from base64 data using summary.py methods
     """
+    from summary import SUMMARY_MODES, inference as summary_inference, pdf_to_base64_images as summary_pdf_to_base64_images
+
+    apply_priority(request)
+    if request.summaryMode is not None and request.summaryMode not in SUMMARY_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown summaryMode {request.summaryMode!r}; use one of {', '.join(SUMMARY_MODES)}")
     try:
         # Decode base64 PDF data
         pdf_bytes = base64.b64decode(request.pdfData)
@@ -140,7 +262,7 @@ async def summarize_pdf_direct(request: ProcessPdfRequest):
         
         try:
             # Convert PDF to base64 images using summary.py method
-            base64_images = summary_pdf_to_base64_images(temp_path)
+            base64_images = await asyncio.to_thread(summary_pdf_to_base64_images, temp_path)
             if base64_images is None:
                 raise HTTPException(
                     status_code=500, detail="Failed to convert PDF to images for summarization."
@@ -159,7 +281,8 @@ async def summarize_pdf_direct(request: ProcessPdfRequest):
                 #     summary_chunks.append(chunk)
                 
                 # full_summary = "".join(summary_chunks)
-                full_summary = summary_inference(base64_images)
+                full_summary = await asyncio.to_thread(summary_inference, base64_images, mode=request.summaryMode)
+                await asyncio.to_thread(index_for_search, request, pdf_bytes, summary=full_summary)
                 
                 # Clean up temporary file after successful summarization
                 try:
@@ -211,11 +334,94 @@ async def summarize_pdf_direct(request: ProcessPdfRequest):
         print(f"Error in direct PDF summarization: {e}")
         raise HTTPException(status_code=500, detail=f"Error in direct PDF summarization: {str(e)}")
 
+@app.post("/process-pdf-summarize")
+async def process_pdf_and_summarize(request: ProcessPdfRequest):
+    """
+    Extract form fields and summarize the PDF in a single pass: every page is
+    rendered once and sent to the model once, asking for both the schema
+    fields and a page summary. The page summaries are then merged text-only.
+    """
+    from qwenmodel_sequential_enhanced import inference_sequential
+    from summary import reduce_summaries
+
+    apply_priority(request)
+    try:
+        try:
+            pdf_data = base64.b64decode(request.pdfData)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid base64 PDF data: {str(e)}")
+
+        compiled_schema = await asyncio.to_thread(resolve_form_schema, request)
+
+        temp_filename = f"temp_pdf_{uuid.uuid4().hex[:12]}.pdf"
+        temp_path = os.path.join(tempfile.gettempdir(), temp_filename)
+
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(pdf_data)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to save PDF: {str(e)}")
+
+        try:
+            pdf_sha256 = hashlib.sha256(pdf_data).hexdigest()
+            base64_images = await asyncio.to_thread(preprocess.model_page_images, temp_path, pdf_sha256)
+            if not base64_images:
+                raise HTTPException(
+                    status_code=500, detail="PDF is empty or no images could be extracted."
+                )
+
+            logger.info(f"[COMBINED] Processing {len(base64_images)} pages for extraction and summary")
+
+            page_summaries = []
+            page_texts = await asyncio.to_thread(preprocess.text_pages, temp_path, pdf_sha256)
+            extracted_data = await asyncio.to_thread(
+                inference_sequential, base64_images, compiled_schema, page_summaries=page_summaries, page_texts=page_texts
+            )
+            full_summary = await asyncio.to_thread(reduce_summaries, page_summaries)
+            await asyncio.to_thread(index_for_search, request, pdf_data, extracted=extracted_data, summary=full_summary)
+
+            logger.info(f"[SUCCESS] Combined processing complete: {len(extracted_data)} fields, summary {len(full_summary)} characters")
+
+            return {
+                "message": "PDF processed and summarized successfully",
+                "pages_processed": len(base64_images),
+                "processing_method": "combined_extraction_summary",
+                "fields_extracted": len(extracted_data),
+                "success": True,
+                "summary": full_summary,
+                "summary_length": len(full_summary),
+                **extracted_data
+            }
+
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"[ERROR] Combined processing failed: {e}")
+            raise HTTPException(
+                status_code=500, detail=f"Combined processing failed: {str(e)}"
+            )
+        finally:
+            try:
+                os.remove(temp_path)
+            except:
+                pass
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error in combined processing: {e}")
+        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+
 @app.post("/process-pdf-direct")
 async def process_pdf_direct(request: ProcessPdfRequest):
     """
     Process PDF directly from base64 data without database storage
     """
+    from qwenmodel import inference, pdf_to_base64_images
+
+    apply_priority(request)
+    compiled_schema = await asyncio.to_thread(resolve_form_schema, request)
+
     try:
         # Decode base64 PDF data
         pdf_bytes = base64.b64decode(request.pdfData)
@@ -230,7 +436,7 @@ async def process_pdf_direct(request: ProcessPdfRequest):
             f.write(pdf_bytes)
         
         print(f"Processing PDF: {temp_filename} ({len(pdf_bytes)} bytes)")
-        print(f"Form schema fields: {list(request.formSchema.keys())}")
+        print(f"Form schema {compiled_schema.schema_id}: {len(compiled_schema.expected_fields)} fields")
         
         if not os.path.exists(temp_path):
             raise HTTPException(
@@ -239,8 +445,7 @@ async def process_pdf_direct(request: ProcessPdfRequest):
             )
 
         try:
-            # Ensure qwenmodel and its functions are correctly imported/defined
-            base64_images = pdf_to_base64_images(temp_path)
+            base64_images = await asyncio.to_thread(pdf_to_base64_images, temp_path)
             if base64_images is None:
                 raise HTTPException(
                     status_code=500, detail="Failed to convert PDF to images."
@@ -253,7 +458,7 @@ async def process_pdf_direct(request: ProcessPdfRequest):
             # Process all pages with AI at once
             try:
                 print(f"🔄 Starting AI inference for {len(base64_images)} pages...")
-                all_extracted_data = inference(base64_images, HTML_CONTENT=request.formSchema)
+                all_extracted_data = await asyncio.to_thread(inference, base64_images, HTML_CONTENT=compiled_schema)
                 
                 if all_extracted_data is None:
                     print("❌ AI inference returned None")
@@ -278,11 +483,9 @@ async def process_pdf_direct(request: ProcessPdfRequest):
                 print(f"⚠️ Warning: No data extracted from any page, though PDF was processed into images.")
 
             # Store temporary file path for potential summarization
-            temp_file_storage[temp_id] = {
-                "temp_path": temp_path,
-                "temp_filename": temp_filename,
-                "created_at": datetime.now()
-            }
+            await asyncio.to_thread(catalog.add_temp_file, temp_id, temp_path, temp_filename)
+            if isinstance(all_extracted_data, dict):
+                await asyncio.to_thread(index_for_search, request, pdf_bytes, extracted=all_extracted_data)
 
             print(f"🎯 Extracted data from {temp_filename}: {list(all_extracted_data.keys())}")
             
@@ -298,19 +501,11 @@ async def process_pdf_direct(request: ProcessPdfRequest):
 
         except HTTPException:
             # Store temp file even on HTTP exceptions for potential summarization
-            temp_file_storage[temp_id] = {
-                "temp_path": temp_path,
-                "temp_filename": temp_filename,
-                "created_at": datetime.now()
-            }
+            await asyncio.to_thread(catalog.add_temp_file, temp_id, temp_path, temp_filename)
             raise
         except Exception as e:
             # Store temp file even on other exceptions for potential summarization
-            temp_file_storage[temp_id] = {
-                "temp_path": temp_path,
-                "temp_filename": temp_filename,
-                "created_at": datetime.now()
-            }
+            await asyncio.to_thread(catalog.add_temp_file, temp_id, temp_path, temp_filename)
             print(f"❌ Unexpected error processing {temp_filename}: {e}")
             import traceback
             traceback.print_exc()
@@ -322,39 +517,85 @@ async def process_pdf_direct(request: ProcessPdfRequest):
         # Store temp file even on final exceptions for potential summarization
         try:
             if 'temp_path' in locals() and 'temp_id' in locals():
-                temp_file_storage[temp_id] = {
-                    "temp_path": temp_path,
-                    "temp_filename": temp_filename if 'temp_filename' in locals() else f"temp_pdf_{temp_id}.pdf",
-                    "created_at": datetime.now()
-                }
+                await asyncio.to_thread(catalog.add_temp_file, temp_id, temp_path, temp_filename if 'temp_filename' in locals() else f"temp_pdf_{temp_id}.pdf")
         except:
             pass
         
         print(f"Error processing PDF: {e}")
         raise HTTPException(status_code=500, detail=f"Error processing PDF: {str(e)}")
 
+@app.post("/schemas")
+async def register_schema(request: RegisterSchemaRequest):
+    """
+    Register a form schema once and get back its schemaId (a content hash).
+    Extraction requests can then send schemaId instead of the full formSchema.
+    The schema is stored in the shared catalog, so every worker resolves it.
+    """
+    compiled = await asyncio.to_thread(schema_registry.register_schema, request.formSchema)
+    return {
+        "schemaId": compiled.schema_id,
+        "fields": compiled.expected_fields,
+        "prompt_size": len(compiled.prompt_fragment),
+    }
+
+def not_modified(request: Request, etag: str, last_modified: float) -> bool:
+    """Conditional GET: If-None-Match wins over If-Modified-Since (RFC 9110)"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
 @app.get("/efile-api/storage/view/{document_id}")
-async def view_pdf(document_id: str):
-    """Serve PDF file for preview in iframe"""
+async def view_pdf(document_id: str, request: Request):
+    """
+    Serve PDF file for preview in iframe. The ETag is the content hash, so
+    browsers revalidate with a 304 instead of downloading again, and Range
+    requests let PDF.js load large files incrementally.
+    """
     try:
         # Check if document exists in our storage
-        if document_id not in file_storage:
+        file_info = await asyncio.to_thread(catalog.get_document, document_id)
+        if file_info is None:
             raise HTTPException(status_code=404, detail="Document not found")
         
-        file_info = file_storage[document_id]
         file_path = file_info["file_path"]
         
         # Check if file exists on disk
-        if not os.path.exists(file_path):
+        try:
+            stat_result = await asyncio.to_thread(os.stat, file_path)
+        except FileNotFoundError:
             raise HTTPException(status_code=404, detail="File not found on disk")
         
-        # Return the PDF file
+        if file_info["sha256"]:
+            etag = f'"{file_info["sha256"]}"'
+        else:
+            # Stored before content hashes were recorded
+            etag = f'"{int(stat_result.st_mtime)}-{stat_result.st_size}"'
+        last_modified = file_info["saved_on"].timestamp()
+        headers = {
+            "ETag": etag,
+            "Last-Modified": formatdate(last_modified, usegmt=True),
+            # A document's content never changes, but it can be deleted: cache privately, for a while
+            "Cache-Control": f"private, max-age={int(os.getenv('VIEW_CACHE_MAX_AGE', '86400'))}",
+        }
+        if not_modified(request, etag, last_modified):
+            return Response(status_code=304, headers=headers)
+        
+        # Return the PDF file; FileResponse answers Range / If-Range requests with 206
         return FileResponse(
             path=file_path,
             media_type="application/pdf",
+            stat_result=stat_result,
             headers={
                 "Content-Disposition": f"inline; filename={file_info['file_name']}",
-                "Cache-Control": "no-cache"
+                **headers,
             }
         )
         
@@ -364,35 +605,91 @@ async def view_pdf(document_id: str):
         logger.error(f"Error serving PDF {document_id}: {e}")
         raise HTTPException(status_code=500, detail=f"Error serving PDF: {str(e)}")
 
+@app.get("/efile-api/storage/page/{document_id}/{page}")
+async def view_page_image(document_id: str, page: int, request: Request, width: int = 200, format: str = "png"):
+    """
+    Image of one page (1-based) of a stored document, scaled to width pixels
+    (default 200, a thumbnail). Rendered once and then served from the page cache.
+    """
+    if format not in page_images.IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(page_images.IMAGE_FORMATS)}")
+    if page < 1:
+        raise HTTPException(status_code=400, detail="page must be 1 or more")
+    width = min(max(width, page_images.MIN_WIDTH), page_images.MAX_WIDTH)
+
+    file_info = await asyncio.to_thread(catalog.get_document, document_id)
+    if file_info is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    if not os.path.exists(file_info["file_path"]):
+        raise HTTPException(status_code=404, detail="File not found on disk")
+
+    etag = f'"{page_images.cache_key(file_info, page, width, format)}"'
+    last_modified = file_info["saved_on"].timestamp()
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(last_modified, usegmt=True),
+        "Cache-Control": f"private, max-age={int(os.getenv('VIEW_CACHE_MAX_AGE', '86400'))}",
+    }
+    if not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        image_path = await asyncio.to_thread(page_images.get_page_image, file_info, page, width, format)
+    except page_images.PageNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error rendering page {page} of {document_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error rendering page: {str(e)}")
+
+    return FileResponse(path=image_path, media_type=f"image/{format}", headers=headers)
+
+@app.delete("/efile-api/storage/{document_id}")
+async def delete_document(document_id: str):
+    """Delete a stored document; the file is removed with the last document referencing its content"""
+    try:
+        file_removed = await asyncio.to_thread(uploads.remove_document, document_id)
+    except Exception as e:
+        logger.error(f"Error deleting document {document_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error deleting document: {str(e)}")
+    if file_removed is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return {"message": "Document deleted", "documentId": document_id, "fileRemoved": file_removed}
+
 @app.get("/search")
-async def search_documents(query: str):
-    """Search documents by name or content"""
+async def search_documents(query: str, page: int = 1, page_size: int = 20):
+    """
+    Full-text search over file names, sender, organisation, subject,
+    reference number and summary. Results are ranked; every query word
+    matches as a prefix.
+    """
     try:
         if not query.strip():
             return {"results": [], "message": "Empty query"}
+        page = max(page, 1)
+        page_size = min(max(page_size, 1), 100)
         
+        documents, total = await asyncio.to_thread(catalog.search, query, page=page, page_size=page_size)
         results = []
-        query_lower = query.lower()
-        
-        # Search through stored documents
-        for doc_id, file_info in file_storage.items():
-            # Search by filename or original filename
-            if (query_lower in file_info["file_name"].lower() or 
-                (file_info.get("original_file_name") and 
-                 query_lower in file_info["original_file_name"].lower()) or
-                query_lower in doc_id.lower()):
-                
-                results.append({
-                    "id": doc_id,
-                    "name": file_info["file_name"],
-                    "original_name": file_info.get("original_file_name"),
-                    "size": file_info["size"],
-                    "saved_on": file_info["saved_on"].isoformat() if isinstance(file_info["saved_on"], datetime) else str(file_info["saved_on"])
-                })
+        for file_info in documents:
+            results.append({
+                "id": file_info["doc_id"],
+                "name": file_info["file_name"],
+                "original_name": file_info.get("original_file_name"),
+                "size": file_info["size"],
+                "saved_on": file_info["saved_on"].isoformat(),
+                "sender": file_info["sender"],
+                "organisation": file_info["organisation"],
+                "subject": file_info["subject"],
+                "refNo": file_info["ref_no"],
+                "snippet": file_info["snippet"],
+                "score": round(-file_info["score"], 4)
+            })
         
         return {
             "results": results,
-            "total": len(results),
+            "total": total,
+            "page": page,
+            "page_size": page_size,
             "query": query
         }
         
@@ -402,7 +699,32 @@ async def search_documents(query: str):
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "version": "1.0", "storage": len(file_storage), "temp_storage": len(temp_file_storage)}
+    return {
+        "status": "healthy",
+        "version": "1.0",
+        "storage": await asyncio.to_thread(catalog.count_documents),
+        "temp_storage": await asyncio.to_thread(catalog.count_temp_files),
+        "temp_files": temp_janitor.stats(),
+        "preprocess": preprocess.status(),
+    }
+
+@app.get("/ready")
+async def readiness_check():
+    """200 once the models are loaded on the backend, 503 while warming up"""
+    status = warmup.status()
+    if not warmup.is_ready():
+        return JSONResponse(status_code=503, content=status)
+    return status
+
+@app.get("/metrics")
+async def get_metrics():
+    """Model call metrics for this worker (token usage, prefix cache hit rate)"""
+    snapshot = metrics.snapshot()
+    pool = get_pool()
+    if pool is not None:
+        snapshot["backends"] = pool.status()
+    snapshot["scheduler"] = scheduler.status()
+    return snapshot
 
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
@@ -412,48 +734,36 @@ async def upload_file(file: UploadFile = File(...)):
         if not filename:
             raise HTTPException(status_code=400, detail="Invalid filename provided by client.")
         
-        # Ensure uploads directory exists
-        uploads_dir = "uploads"
-        os.makedirs(uploads_dir, exist_ok=True)
-        
-        # Create unique filename to avoid conflicts
-        base_name, ext = os.path.splitext(filename)
-        unique_filename = f"{base_name}_{uuid.uuid4().hex[:8]}{ext}"
-        file_path = os.path.join(uploads_dir, unique_filename)
-        
+        doc_id = uuid.uuid4().hex[:24]
         try:
-            content = await file.read()
-            file_size = len(content)
-            
-            # Write file to disk
-            with open(file_path, "wb") as f:
-                f.write(content)
-                
+            # Stream into the blob store in a worker thread, hashing and counting
+            # pages on the way; content already stored is not written again
+            upload, file_path, deduplicated = await asyncio.to_thread(
+                uploads.store_upload, file.file, doc_id, original_filename, file.content_type
+            )
+        except uploads.UploadTooLarge as e:
+            raise HTTPException(status_code=413, detail=f"File exceeds the maximum upload size of {e.max_bytes} bytes")
         except IOError as e:
-            logger.error(f"IOError writing file {file_path}: {e}")
+            logger.error(f"IOError storing file {filename}: {e}")
             raise HTTPException(status_code=500, detail="Could not write file to disk.")
         except Exception as e:
             logger.error(f"Error handling file {filename}: {e}")
             raise HTTPException(status_code=500, detail=f"Error handling file: {str(e)}")
+        finally:
+            await file.close()
         
-        # Generate document ID
-        doc_id = uuid.uuid4().hex[:24]
-        file_storage[doc_id] = {
-            "doc_id": doc_id,
-            "file_name": unique_filename,
-            "original_file_name": original_filename,
-            "mime_type": file.content_type,
-            "size": file_size,
-            "saved_on": datetime.now(),
-            "file_path": file_path
-        }
-        
-        logger.info(f"Uploaded: {original_filename} -> {unique_filename} (ID: {doc_id}, Size: {file_size} bytes)")
+        preprocessing = preprocess.enqueue(doc_id)
+        logger.info(f"Uploaded: {original_filename} -> {file_path} (ID: {doc_id}, Size: {upload.size} bytes, Pages: {upload.page_count}, deduplicated: {deduplicated})")
         
         return {
             "message": "File uploaded successfully",
             "documentId": doc_id,
             "filePath": file_path,
+            "size": upload.size,
+            "sha256": upload.sha256,
+            "pageCount": upload.page_count,
+            "deduplicated": deduplicated,
+            "preprocessing": preprocessing,
         }
         
     except HTTPException:
@@ -0,0 +1,119 @@
+"""
+Benchmark /search query latency on a synthetic catalog.
+
+    python bench_search.py [--documents 100000] [--queries 200] [--catalog bench_catalog.db]
+
+Fills a throwaway catalog with synthetic letters (file names, sender,
+organisation, subject, reference number, summary), then times
+catalog.search() for several query shapes and prints p50/p95/p99 latency.
+Delete the catalog file afterwards (or pass --keep to reuse it).
+"""
+import argparse
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+FIRST_NAMES = ["Anil", "Sunita", "Rajesh", "Priya", "Vikram", "Meena", "Arjun", "Kavita", "Suresh", "Deepa",
+               "Ramesh", "Lakshmi", "Manoj", "Anjali", "Sanjay", "Pooja", "Harish", "Neha", "Gopal", "Divya"]
+LAST_NAMES = ["Sharma", "Verma", "Iyer", "Nair", "Reddy", "Gupta", "Menon", "Pillai", "Rao", "Kumar",
+              "Singh", "Das", "Joshi", "Mehta", "Patel", "Bose", "Chatterjee", "Kulkarni", "Pandey", "Mishra"]
+ORGANISATIONS = ["Ministry of Finance", "Department of Revenue", "Public Works Department", "Kerala State Electricity Board",
+                 "Directorate of Health Services", "Department of Education", "Municipal Corporation", "District Collectorate",
+                 "Police Headquarters", "Forest Department", "Transport Commissionerate", "Water Authority"]
+SUBJECTS = ["Sanction of funds for road repair", "Request for transfer of staff", "Audit observations on accounts",
+            "Allotment of quarters", "Procurement of computers", "Leave travel concession claim",
+            "Pension revision arrears", "Land acquisition compensation", "Annual budget estimates",
+            "Grievance regarding water supply", "Renewal of contract", "Inspection report of hospital"]
+WORDS = ("the of and to in for on with by from this that request approval letter department office report "
+         "payment budget staff meeting district scheme project review compliance committee order").split()
+
+
+def _document(rng, index, start):
+    name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+    subject = rng.choice(SUBJECTS)
+    return {
+        "doc_id": uuid.UUID(int=rng.getrandbits(128)).hex[:24],
+        "file_name": f"{subject.split()[0].lower()}_{index}_{rng.getrandbits(32):08x}.pdf",
+        "original_file_name": f"{subject.split()[0].lower()}_{index}.pdf",
+        "saved_on": start + timedelta(seconds=index * 30),
+        "sender": name,
+        "organisation": rng.choice(ORGANISATIONS),
+        "subject": subject,
+        "ref_no": f"No.{rng.randint(1, 999)}/{rng.choice(['A', 'B', 'C', 'EST', 'FIN'])}/{rng.randint(2015, 2025)}",
+        "summary": " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120))),
+    }
+
+
+def populate(catalog, count, seed=1):
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    started = time.perf_counter()
+    batch = 5000
+    for offset in range(0, count, batch):
+        with catalog.transaction():
+            for index in range(offset, min(offset + batch, count)):
+                doc = _document(rng, index, start)
+                catalog.add_document(
+                    doc_id=doc["doc_id"], file_name=doc["file_name"], original_file_name=doc["original_file_name"],
+                    mime_type="application/pdf", size=rng.randint(20_000, 2_000_000),
+                    file_path=os.path.join("uploads", doc["file_name"]), saved_on=doc["saved_on"],
+                )
+                catalog.index_document_text(
+                    doc["doc_id"], sender=doc["sender"], organisation=doc["organisation"],
+                    subject=doc["subject"], ref_no=doc["ref_no"], summary=doc["summary"],
+                )
+    print(f"Indexed {count} documents in {time.perf_counter() - started:.1f}s")
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return pick(0.50), pick(0.95), pick(0.99)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark catalog full-text search")
+    parser.add_argument("--documents", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--catalog", default="bench_catalog.db")
+    parser.add_argument("--keep", action="store_true", help="reuse an existing benchmark catalog")
+    args = parser.parse_args()
+
+    if not args.keep:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.catalog + suffix):
+                os.remove(args.catalog + suffix)
+    os.environ["CATALOG_PATH"] = args.catalog
+    import catalog
+
+    if catalog.count_documents() < args.documents:
+        populate(catalog, args.documents - catalog.count_documents())
+
+    rng = random.Random(2)
+    shapes = {
+        "sender surname": lambda: rng.choice(LAST_NAMES),
+        "sender full name": lambda: f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        "prefix (3 chars)": lambda: rng.choice(LAST_NAMES)[:3],
+        "organisation + subject": lambda: f"{rng.choice(ORGANISATIONS).split()[-1]} {rng.choice(SUBJECTS).split()[-1]}",
+        "reference number": lambda: f"No {rng.randint(1, 999)}",
+        "summary word, page 10": lambda: rng.choice(WORDS),
+    }
+
+    print(f"{'query':>24} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'avg hits':>9}")
+    for label, make_query in shapes.items():
+        page = 10 if "page 10" in label else 1
+        timings, hits = [], 0
+        for _ in range(args.queries):
+            query = make_query()
+            started = time.perf_counter()
+            _, total = catalog.search(query, page=page, page_size=20)
+            timings.append(time.perf_counter() - started)
+            hits += total
+        p50, p95, p99 = _percentiles(timings)
+        print(f"{label:>24} {p50:8.2f} {p95:8.2f} {p99:8.2f} {hits / args.queries:9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+"""
+Document catalog shared by all uvicorn workers.
+
+Uploaded documents and the temporary PDFs kept for summarization are
+recorded in SQLite (CATALOG_PATH, default catalog.db) instead of
+per-process dicts, so any worker can serve a documentId another worker
+stored, and the catalog survives restarts. WAL mode lets readers run while
+a worker writes. Lookups are indexed by doc_id, content hash and upload
+time.
+
+Full-text search runs on an FTS5 index over file names and the text known
+about each document: sender, organisation, subject and reference number
+from extraction, and the summary. Extraction and summarization results are
+indexed when they finish (see index_extraction / index_summary); search()
+returns bm25-ranked, paginated results and treats every query word as a
+prefix.
+
+Registered form schemas are kept here too, so a schemaId registered on one
+worker resolves on every other (schema_registry caches them per worker).
+
+Temp file records are removed by temp_janitor when they expire or the temp
+disk quota is exceeded.
+
+Each thread keeps its own connection; the schema is created on first use.
+"""
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+_local = threading.local()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    doc_id TEXT PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    original_file_name TEXT,
+    mime_type TEXT,
+    size INTEGER NOT NULL,
+    sha256 TEXT,
+    page_count INTEGER,
+    saved_on TEXT NOT NULL,
+    file_path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_sha256 ON documents (sha256);
+CREATE INDEX IF NOT EXISTS documents_saved_on ON documents (saved_on);
+
+-- Content-addressed upload files; refcount = documents pointing at the blob
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    refcount INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS temp_files (
+    temp_id TEXT PRIMARY KEY,
+    temp_path TEXT NOT NULL,
+    temp_filename TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS temp_files_created_at ON temp_files (created_at);
+
+-- Form schemas registered through /schemas, in canonical JSON, keyed by schema id
+CREATE TABLE IF NOT EXISTS form_schemas (
+    schema_id TEXT PRIMARY KEY,
+    canonical_schema TEXT NOT NULL,
+    registered_at TEXT NOT NULL
+);
+
+-- Searchable text per document; documents_fts indexes it (external content)
+CREATE TABLE IF NOT EXISTS document_text (
+    doc_id TEXT PRIMARY KEY,
+    file_name TEXT,
+    original_file_name TEXT,
+    sender TEXT,
+    organisation TEXT,
+    subject TEXT,
+    ref_no TEXT,
+    summary TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+    doc_id, file_name, original_file_name, sender, organisation, subject, ref_no, summary,
+    content='document_text', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS document_text_ai AFTER INSERT ON document_text BEGIN
+    INSERT INTO documents_fts (rowid, doc_id, file_name, original_file_name, sender, organisation, subject, ref_no, summary)
+    VALUES (new.rowid, new.doc_id, new.file_name, new.original_file_name, new.sender, new.organisation, new.subject, new.ref_no, new.summary);
+END;
+CREATE TRIGGER IF NOT EXISTS document_text_ad AFTER DELETE ON document_text BEGIN
+    INSERT INTO documents_fts (documents_fts, rowid, doc_id, file_name, original_file_name, sender, organisation, subject, ref_no, summary)
+    VALUES ('delete', old.rowid, old.doc_id, old.file_name, old.original_file_name, old.sender, old.organisation, old.subject, old.ref_no, old.summary);
+END;
+CREATE TRIGGER IF NOT EXISTS document_text_au AFTER UPDATE ON document_text BEGIN
+    INSERT INTO documents_fts (documents_fts, rowid, doc_id, file_name, original_file_name, sender, organisation, subject, ref_no, summary)
+    VALUES ('delete', old.rowid, old.doc_id, old.file_name, old.original_file_name, old.sender, old.organisation, old.subject, old.ref_no, old.summary);
+    INSERT INTO documents_fts (rowid, doc_id, file_name, original_file_name, sender, organisation, subject, ref_no, summary)
+    VALUES (new.rowid, new.doc_id, new.file_name, new.original_file_name, new.sender, new.organisation, new.subject, new.ref_no, new.summary);
+END;
+"""
+
+# Search columns filled from extracted form fields: column -> candidate field names
+EXTRACTED_SEARCH_FIELDS = {
+    "sender": ("name", "senderName"),
+    "organisation": ("organisation", "organization", "senderOrganisation"),
+    "subject": ("subject", "letterSubject"),
+    "ref_no": ("letterRefNo", "refNo", "referenceNo"),
+}
+
+# bm25 weights in documents_fts column order: doc_id, file_name,
+# original_file_name, sender, organisation, subject, ref_no, summary
+_BM25_WEIGHTS = (1.0, 2.0, 2.0, 5.0, 3.0, 4.0, 5.0, 1.0)
+
+
+def catalog_path():
+    return os.getenv("CATALOG_PATH", "catalog.db")
+
+
+def _connection():
+    """This thread's connection to the catalog, opened (and the schema created) on first use"""
+    path = catalog_path()
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.path == path:
+        return conn
+
+    conn = sqlite3.connect(path, timeout=float(os.getenv("CATALOG_BUSY_TIMEOUT", "5")), isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    _migrate(conn)
+    _local.conn = conn
+    _local.path = path
+    return conn
+
+
+def _migrate(conn):
+    """Bring catalogs created by earlier versions up to the current schema"""
+    columns = {row["name"] for row in conn.execute("PRAGMA table_info(documents)")}
+    if "page_count" not in columns:
+        conn.execute("ALTER TABLE documents ADD COLUMN page_count INTEGER")
+
+    # One-off data migrations, tracked in user_version so they run once per catalog
+    if conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] < 1:  # another process may have run it
+                # Documents catalogued before the search index existed
+                conn.execute(
+                    "INSERT INTO document_text (doc_id, file_name, original_file_name) "
+                    "SELECT doc_id, file_name, original_file_name FROM documents "
+                    "WHERE doc_id NOT IN (SELECT doc_id FROM document_text)"
+                )
+                conn.execute("PRAGMA user_version = 1")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+@contextmanager
+def transaction():
+    """Group several writes into one transaction (one WAL commit); nested blocks join the outer one"""
+    conn = _connection()
+    if conn.in_transaction:
+        yield
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _document(row):
+    if row is None:
+        return None
+    document = dict(row)
+    document["saved_on"] = datetime.fromisoformat(document["saved_on"])
+    return document
+
+
+def add_document(doc_id, file_name, original_file_name, mime_type, size, file_path, sha256=None, saved_on=None,
+                 page_count=None):
+    saved_on = saved_on or datetime.now()
+    with transaction():
+        _connection().execute(
+            "INSERT INTO documents (doc_id, file_name, original_file_name, mime_type, size, sha256, page_count, saved_on, file_path) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (doc_id, file_name, original_file_name, mime_type, size, sha256, page_count, saved_on.isoformat(), file_path),
+        )
+        index_document_text(doc_id, file_name=file_name, original_file_name=original_file_name)
+
+
+def get_document(doc_id):
+    """Return the document record (saved_on as a datetime), or None"""
+    row = _connection().execute("SELECT * FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+    return _document(row)
+
+
+def find_by_hash(sha256):
+    """Documents with the given content hash, newest first"""
+    rows = _connection().execute(
+        "SELECT * FROM documents WHERE sha256 = ? ORDER BY saved_on DESC", (sha256,)
+    ).fetchall()
+    return [_document(row) for row in rows]
+
+
+def delete_document(doc_id):
+    with transaction():
+        conn = _connection()
+        conn.execute("DELETE FROM document_text WHERE doc_id = ?", (doc_id,))
+        conn.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,))
+
+
+def add_blob_reference(sha256, size, path):
+    """Count one more reference to a blob, recording it first if new; True when it already existed"""
+    with transaction():
+        conn = _connection()
+        updated = conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = ?", (sha256,)).rowcount
+        if not updated:
+            conn.execute(
+                "INSERT INTO blobs (sha256, size, path, refcount, created_at) VALUES (?, ?, ?, 1, ?)",
+                (sha256, size, path, datetime.now().isoformat()),
+            )
+    return bool(updated)
+
+
+def get_blob(sha256):
+    row = _connection().execute("SELECT * FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+    return dict(row) if row else None
+
+
+def release_blob(sha256):
+    """Drop one reference to a blob; returns the references left (the record goes at 0)"""
+    with transaction():
+        conn = _connection()
+        conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?", (sha256,))
+        row = conn.execute("SELECT refcount FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is None:
+            return 0
+        if row["refcount"] <= 0:
+            conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+        return max(row["refcount"], 0)
+
+
+def list_documents(since=None, until=None, limit=100):
+    """Documents uploaded in [since, until), newest first"""
+    clauses, params = [], []
+    if since is not None:
+        clauses.append("saved_on >= ?")
+        params.append(since.isoformat())
+    if until is not None:
+        clauses.append("saved_on < ?")
+        params.append(until.isoformat())
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = _connection().execute(
+        f"SELECT * FROM documents {where} ORDER BY saved_on DESC LIMIT ?", (*params, limit)
+    ).fetchall()
+    return [_document(row) for row in rows]
+
+
+def index_document_text(doc_id, **columns):
+    """
+    Set searchable text columns for a document (file_name, original_file_name,
+    sender, organisation, subject, ref_no, summary); None leaves a column as is.
+    """
+    columns = {name: value for name, value in columns.items() if value is not None}
+    names = ["doc_id", *columns]
+    updates = ", ".join(f"{name} = excluded.{name}" for name in columns) or "doc_id = doc_id"
+    _connection().execute(
+        f"INSERT INTO document_text ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+        f"ON CONFLICT (doc_id) DO UPDATE SET {updates}",
+        (doc_id, *columns.values()),
+    )
+
+
+def _text(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, (list, tuple)):
+        return ", ".join(str(item) for item in value if item not in (None, "")) or None
+    return str(value)
+
+
+def index_extraction(doc_ids, extracted):
+    """Index sender, organisation, subject and reference number from extracted form data"""
+    columns = {}
+    for column, fields in EXTRACTED_SEARCH_FIELDS.items():
+        for field in fields:
+            value = _text(extracted.get(field))
+            if value:
+                columns[column] = value
+                break
+    if not columns:
+        return
+    for doc_id in doc_ids:
+        index_document_text(doc_id, **columns)
+
+
+def index_summary(doc_ids, summary):
+    if not _text(summary):
+        return
+    for doc_id in doc_ids:
+        index_document_text(doc_id, summary=summary)
+
+
+def _fts_query(query):
+    """Quote every word of the user's query and match it as a prefix (all words must match)"""
+    words = re.findall(r"\w+", query)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search(query, page=1, page_size=20):
+    """
+    Ranked full-text search. Returns (documents, total); each document carries
+    the indexed text columns, a highlighted snippet and its bm25 score (lower
+    is better).
+    """
+    match = _fts_query(query)
+    if not match:
+        return [], 0
+
+    conn = _connection()
+    total = conn.execute("SELECT COUNT(*) FROM documents_fts WHERE documents_fts MATCH ?", (match,)).fetchone()[0]
+    weights = ", ".join(str(weight) for weight in _BM25_WEIGHTS)
+    rows = conn.execute(
+        f"""
+        SELECT d.*, t.sender, t.organisation, t.subject, t.ref_no,
+               snippet(documents_fts, -1, '[', ']', '...', 12) AS snippet,
+               bm25(documents_fts, {weights}) AS score
+        FROM documents_fts
+        JOIN document_text t ON t.rowid = documents_fts.rowid
+        JOIN documents d ON d.doc_id = t.doc_id
+        WHERE documents_fts MATCH ?
+        ORDER BY score
+        LIMIT ? OFFSET ?
+        """,
+        (match, page_size, (page - 1) * page_size),
+    ).fetchall()
+    return [_document(row) for row in rows], total
+
+
+def count_documents():
+    return _connection().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+
+def add_form_schema(schema_id, canonical_schema):
+    """Record a registered form schema; registering the same schema again keeps the first record"""
+    _connection().execute(
+        "INSERT OR IGNORE INTO form_schemas (schema_id, canonical_schema, registered_at) VALUES (?, ?, ?)",
+        (schema_id, canonical_schema, datetime.now().isoformat()),
+    )
+
+
+def get_form_schema(schema_id):
+    """The canonical JSON of a registered form schema, or None"""
+    row = _connection().execute(
+        "SELECT canonical_schema FROM form_schemas WHERE schema_id = ?", (schema_id,)
+    ).fetchone()
+    return row["canonical_schema"] if row else None
+
+
+def _temp_file(row):
+    if row is None:
+        return None
+    temp_file = dict(row)
+    temp_file["created_at"] = datetime.fromisoformat(temp_file["created_at"])
+    return temp_file
+
+
+def add_temp_file(temp_id, temp_path, temp_filename, created_at=None):
+    """Record a temporary PDF kept for a later summarization request (replaces an earlier record)"""
+    created_at = (created_at or datetime.now()).isoformat()
+    _connection().execute(
+        "INSERT OR REPLACE INTO temp_files (temp_id, temp_path, temp_filename, created_at) VALUES (?, ?, ?, ?)",
+        (temp_id, temp_path, temp_filename, created_at),
+    )
+
+
+def list_temp_files():
+    """All temp file records, oldest first"""
+    rows = _connection().execute("SELECT * FROM temp_files ORDER BY created_at").fetchall()
+    return [_temp_file(row) for row in rows]
+
+
+def delete_temp_file(temp_id):
+    _connection().execute("DELETE FROM temp_files WHERE temp_id = ?", (temp_id,))
+
+
+def count_temp_files():
+    return _connection().execute("SELECT COUNT(*) FROM temp_files").fetchone()[0]
@@ -0,0 +1,85 @@
+"""
+Import-time budget for the app, so cold starts (and worker restarts) stay fast.
+
+    python check_import_time.py [--budget-ms 800] [--runs 3]
+
+Imports app.py in fresh interpreters with `python -X importtime` and fails
+(exit code 1) when the fastest run exceeds the budget, or when app.py pulls
+in one of the modules that are meant to load on first use (model client,
+pdf2image/PIL, the inference modules).
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Loaded on the first request, never at import
+LAZY_MODULES = (
+    "openai",
+    "httpx",
+    "pdf2image",
+    "PIL",
+    "qwenmodel",
+    "qwenmodel_sequential_enhanced",
+    "summary",
+)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _import_times():
+    """Return {module: cumulative microseconds} for one cold import of app"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=HERE, capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        try:
+            times[name.strip()] = int(cumulative)
+        except ValueError:
+            continue  # header line
+    return times
+
+
+def _eager_lazy_modules():
+    code = "import sys, app; print(' '.join(m for m in %r if m in sys.modules))" % (LAZY_MODULES,)
+    result = subprocess.run([sys.executable, "-c", code], cwd=HERE, capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of app.py against a budget")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_TIME_BUDGET_MS", "800")))
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    runs = [_import_times() for _ in range(args.runs)]
+    fastest = min(runs, key=lambda times: times.get("app", 0))
+    total_ms = fastest["app"] / 1000
+
+    top_level = sorted(
+        ((name, us) for name, us in fastest.items() if "." not in name and name != "app"),
+        key=lambda item: item[1], reverse=True,
+    )
+    print(f"import app: {total_ms:.0f} ms (budget {args.budget_ms:.0f} ms, fastest of {args.runs})")
+    for name, us in top_level[:10]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if total_ms > args.budget_ms:
+        print(f"FAIL: import time {total_ms:.0f} ms is over the {args.budget_ms:.0f} ms budget")
+        failed = True
+    eager = _eager_lazy_modules()
+    if eager:
+        print(f"FAIL: imported at startup instead of on first use: {', '.join(eager)}")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Regression check for the rule-based extractors against a text-layer corpus.
+
+    python check_local_extractors.py
+
+Each fixtures/local_extractors/*.txt holds the pdftotext -layout output of
+one letter (pages separated by form feeds); expected.json lists the
+{field: [value, confidence]} that extract_fields() must return for it.
+
+The confident hits are not requested from the model, so the sequential
+extractor must return them even when the model answers every page with {}
+(as stub_llm_server does): that is checked on the same fixtures.
+Exits with code 1 when any fixture differs, or has no expectation.
+"""
+import glob
+import json
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+from local_extractors import confident_fields, extract_fields
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, "fixtures", "local_extractors")
+
+
+def _fixture_pages():
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "*.txt"))):
+        with open(path, encoding="utf-8") as f:
+            yield os.path.basename(path), f.read().split("\f")
+
+
+def _check_empty_model_answers():
+    """Run the sequential extractor against a stub model that answers {}; returns whether it passed"""
+    from stub_llm_server import make_handler
+
+    handler = make_handler(0, 0.0, False)
+    handler.log_message = lambda *args: None
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ.update(
+        OPENAI_BASE_URL=f"http://127.0.0.1:{server.server_port}/v1", OPENAI_BASE_URLS="", OPENAI_API_KEY="stub",
+        OPENAI_MODEL="stub", OPENAI_MODEL_SMALL="", LLM_BACKEND="openai",
+    )
+    from qwenmodel_sequential_enhanced import inference_sequential
+
+    failed = False
+    try:
+        for name, pages in _fixture_pages():
+            rule_fields = extract_fields(pages)
+            schema = {field: {"type": "text"} for field in ("name", "subject", *rule_fields)}
+            got = inference_sequential(["data:image/png;base64,"] * len(pages), schema, page_texts=pages)
+            lost = {field: rule_fields[field][0] for field in confident_fields(rule_fields)
+                    if got.get(field) != rule_fields[field][0]}
+            if lost:
+                print(f"FAIL {name} with empty model answers: lost {lost}")
+                failed = True
+            else:
+                print(f"ok   {name} with empty model answers")
+    finally:
+        server.shutdown()
+    return not failed
+
+
+def main():
+    with open(os.path.join(FIXTURES, "expected.json"), encoding="utf-8") as f:
+        expected = json.load(f)
+
+    failed = False
+    for name, pages in _fixture_pages():
+        got = {field: [value, confidence] for field, (value, confidence) in extract_fields(pages).items()}
+        if name not in expected:
+            print(f"FAIL {name}: no entry in expected.json (got {got})")
+            failed = True
+        elif got != expected[name]:
+            print(f"FAIL {name}")
+            for field in sorted(set(got) | set(expected[name])):
+                if got.get(field) != expected[name].get(field):
+                    print(f"  {field}: expected {expected[name].get(field)}, got {got.get(field)}")
+            failed = True
+        else:
+            print(f"ok   {name}")
+
+    if not _check_empty_model_answers():
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
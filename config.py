@@ -1,3 +1,4 @@
+import json
 import logging
 
 # Configure logging
@@ -5,12 +6,23 @@ logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('app.log'),
+        # delay: the log file is opened on the first record, not at import
+        logging.FileHandler('app.log', delay=True),
         logging.StreamHandler()
     ]
 )
 logger = logging.getLogger(__name__)
 
+
+def canonical_schema(form_schema):
+    """
+    Serialize a form schema deterministically (sorted keys, compact separators)
+    so the same form always produces byte-identical prompt text, independent
+    of the field order the page DOM happened to produce. Backends with prefix
+    caching can then reuse the KV cache across requests for the same form.
+    """
+    return json.dumps(form_schema, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
 FORM_SYSTEM_PROMPT = """
 You are an expert AI assistant specialized in extracting structured information from documents and populating dynamic JSON schemas. Your task is to meticulously analyze the provided document image and accurately fill the given JSON schema. The schema structure (field names, their types, requirements, options, and default values) can vary with each request.
 
@@ -141,6 +153,71 @@ This is a compression task. Think like an executive summary writer. Prioritize c
 
 """
 
+TREE_PAGE_SUMMARY_PROMPT = """
+You are a document analysis expert. You will be given one or more consecutive pages of a larger multi-page document. Summarize only the pages you are given; other pages are summarized separately and merged later.
+
+Strict Output Rules:
+- **Keep the summary under 120 words**
+- **Capture the purpose of these pages and any essential facts, requests, decisions or deadlines**
+- **Do not speculate about content from other pages**
+- Your output must be in **plain text only** with no formatting, bullet points, or special symbols
+"""
+
+TREE_MERGE_SYSTEM_PROMPT = """
+You are a document analysis expert. You will be given partial summaries of consecutive sections of one multi-page document, in document order. Merge them into a single cohesive summary of the whole span.
+
+Strict Output Rules:
+- **Remove any redundancy between the partial summaries**
+- **Prioritize importance over completeness and drop minor, repetitive, or procedural content**
+- **Avoid listing — rewrite into dense, narrative prose**
+- Your output must be in **plain text only** with no formatting, bullet points, or special symbols
+"""
+
+DELTA_SUMMARY_SYSTEM_PROMPT = """
+You are a document analysis expert maintaining a running list of key points for a multi-page document. For each page you receive the current numbered key points (possibly empty) and the next page image.
+
+Do NOT rewrite the key points. Return only the changes this page requires, as a single JSON object:
+
+```json
+{
+  "add": ["new key point", "..."],
+  "update": {"2": "corrected text of key point 2"},
+  "remove": [5]
+}
+```
+
+Rules:
+- **Each key point is one short sentence of essential information (purpose, requests, decisions, deadlines)**
+- **Add only information that is new; use "update" when the page corrects or refines an existing point**
+- **Use "remove" only for points this page shows to be wrong or superseded**
+- **Ignore minor, repetitive, or procedural content**
+- Use empty lists/objects when nothing changes. Output the JSON object only.
+"""
+
+DELTA_POLISH_SYSTEM_PROMPT = """
+You are a document analysis expert. You will be given the key points collected from every page of a document, in document order. Write the final summary of the whole document from them.
+
+Strict Output Rules:
+- **The full summary must never exceed 250 words**
+- **You must prioritize importance over completeness**
+- **Avoid listing — rewrite into dense, narrative prose**
+- **The summary must be structured as numbered short paragraphs (e.g., 1., 2., 3.)**
+- **Each paragraph should be 3–4 lines long, focused on one core idea**
+- Your output must be in **plain text only** with no formatting, bullet points, or special symbols
+"""
+
+PAGE_SUMMARY_INSTRUCTION = """
+In addition to the schema fields, include one extra key "pageSummary" in the same JSON object: a plain text summary of this page only, under 120 words, capturing its purpose and any essential facts, requests, decisions or deadlines. Do not speculate about other pages.
+"""
+
+SPARSE_OUTPUT_INSTRUCTION = """
+OUTPUT ONLY FOUND FIELDS: This overrides the rule to output all schema keys. Include only the fields for which you found a value in the document (plus senderConfidence and senderConfidenceReason when you extracted sender fields). Omit every field that would be null; omitted fields are filled in automatically, and values from previous pages are kept without being repeated.
+"""
+
+SPARSE_ALIAS_INSTRUCTION = """
+SHORT KEYS: Each schema entry is keyed by a short key (e.g. "f3") and names its form field in "field". Use the short keys, not the field names, as the keys of your JSON output.
+"""
+
 # SEQUENTIAL_SYSTEM_PROMPT = """
 # You are an AI assistant for sequential processing of multi-page official letters. Process each page while maintaining context from previous pages to build a complete structured JSON output.
 
@@ -4,11 +4,18 @@ set -e
 echo "Starting Ollama server in background..."
 ollama serve &
 
-sleep 10
+echo "Waiting for Ollama server..."
+for i in $(seq 1 "${OLLAMA_STARTUP_TIMEOUT:-120}"); do
+    if ollama list > /dev/null 2>&1; then
+        break
+    fi
+    sleep 1
+done
+ollama list > /dev/null 2>&1 || { echo "Ollama server did not start"; exit 1; }
 
 echo "Pulling model if not already present..."
 ollama pull gemma3:27b
 
 echo "Running app.py..."
+# The app warms the model itself and reports readiness on /ready
 python3 app.py
-
@@ -0,0 +1,602 @@
+"""
+Model backend adapters behind one chat() call.
+
+LLM_BACKEND selects the adapter for OPENAI_BASE_URL:
+
+- "openai" (default): any OpenAI-compatible /v1 server (Ollama's /v1,
+  llama.cpp server, hosted APIs)
+- "ollama": Ollama's native /api/chat, which takes keep_alive and num_ctx
+  (OLLAMA_KEEP_ALIVE, OLLAMA_NUM_CTX) that the /v1 endpoint ignores
+- "vllm": vLLM's OpenAI-compatible server with automatic prefix caching
+
+Every adapter returns an OpenAI ChatCompletion, so callers read
+response.choices[0].message.content and response.usage the same way for all
+backends. All adapters share one tuned httpx connection pool with keep-alive
+(LLM_MAX_CONNECTIONS, LLM_KEEPALIVE_EXPIRY, LLM_CONNECT_TIMEOUT, LLM_TIMEOUT),
+and each exposes `capabilities` (structured output modes, prefix caching) so
+features can be switched per backend.
+openai and httpx are imported on first use, which keeps app startup light.
+
+OPENAI_BASE_URLS (comma separated) spreads requests over several servers of
+the same LLM_BACKEND type through a BackendPool: least-outstanding-requests
+routing, active health checks, ejection of failing servers and re-admission
+once they recover. Calls inside sticky_routing() (one document) stay on one
+server so its pages reuse that server's warm KV cache.
+
+With LLM_HEDGE=on, pool calls made with hedge=True (extraction page calls)
+that have not returned after about the p95 latency (LLM_HEDGE_QUANTILE) are
+duplicated to another server and the first answer wins. Hedges are capped
+at LLM_HEDGE_BUDGET_PERCENT of eligible calls.
+
+chat() calls are admitted by the priority scheduler (scheduler.py), which
+limits concurrent model calls and lets interactive requests overtake batch
+and background work.
+"""
+import contextvars
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from contextlib import contextmanager
+
+from config import logger
+import metrics
+from scheduler import model_slot
+
+_lock = threading.Lock()
+_http_client = None
+_backends = {}
+_pools = {}
+_routing_key = contextvars.ContextVar("llm_routing_key", default=None)
+_last_activity = time.monotonic()
+
+
+def http_client():
+    """The process-wide httpx pool shared by all backend adapters"""
+    global _http_client
+    if _http_client is not None:
+        return _http_client
+
+    import httpx
+
+    with _lock:
+        if _http_client is None:
+            max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
+            _http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                    keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "120")),
+                ),
+                timeout=httpx.Timeout(
+                    float(os.getenv("LLM_TIMEOUT", "600")),
+                    connect=float(os.getenv("LLM_CONNECT_TIMEOUT", "10")),
+                ),
+            )
+    return _http_client
+
+
+def idle_seconds():
+    """Seconds since the last model call (warm-up requests do not count)"""
+    return time.monotonic() - _last_activity
+
+
+class Backend:
+    """OpenAI-compatible chat completions backend"""
+
+    name = "openai"
+    # structured_output: response_format types the backend can honour
+    # prefix_caching: the server reuses the KV cache of a repeated prompt prefix
+    # (the sequential extractor then defaults to its conversation context mode)
+    capabilities = {
+        "structured_output": ("json_schema", "json_object"),
+        "prefix_caching": False,
+    }
+
+    def __init__(self, base_url, api_key=None, max_retries=2):
+        from openai import OpenAI
+
+        self.base_url = base_url
+        self.api_key = api_key or "unused"
+        self._unsupported = set()
+        self._client = OpenAI(base_url=base_url, api_key=self.api_key, http_client=http_client(),
+                              max_retries=max_retries)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.base_url})"
+
+    def _health_url(self):
+        return f"{self.base_url.rstrip('/')}/models"
+
+    def health_check(self, timeout=2.0):
+        """True when the server answers its model listing endpoint"""
+        import httpx
+
+        try:
+            response = http_client().get(
+                self._health_url(), timeout=timeout,
+                headers={"Authorization": f"Bearer {self.api_key}"} if self.api_key else None,
+            )
+        except httpx.HTTPError:
+            return False
+        return response.is_success
+
+    def _create(self, **kwargs):
+        return self._client.chat.completions.create(**kwargs)
+
+    def warm_up(self, model):
+        """Make the server load model with a one-token request"""
+        self._create(model=model, messages=[{"role": "user", "content": "Hi"}], max_tokens=1, temperature=0)
+
+    def chat(self, response_format=None, hedge=False, **kwargs):
+        """
+        Chat completion with response_format when the backend supports it. A
+        400 caused by response_format disables that mode for this backend and
+        the request is retried unconstrained. hedge only matters for a
+        BackendPool. Waits for a model call slot at the caller's priority.
+        """
+        with model_slot():
+            return self.request(response_format=response_format, **kwargs)
+
+    def request(self, response_format=None, **kwargs):
+        """chat() without waiting for a slot: one call on this server (BackendPool sends through this)"""
+        from openai import BadRequestError
+
+        global _last_activity
+        _last_activity = time.monotonic()
+
+        if response_format is not None:
+            mode = response_format["type"]
+            with _lock:
+                supported = mode in self.capabilities["structured_output"] and mode not in self._unsupported
+            if not supported:
+                response_format = None
+
+        if response_format is None:
+            return self._create(**kwargs)
+
+        try:
+            return self._create(response_format=response_format, **kwargs)
+        except BadRequestError as e:
+            logger.warning(f"Backend {self.base_url} rejected response_format "
+                           f"{response_format['type']}, retrying with unconstrained output: {e}")
+            # Only remember the rejection when the error is about the format itself
+            if any(word in str(e).lower() for word in ("response_format", "json_schema", "schema", "format")):
+                with _lock:
+                    self._unsupported.add(response_format["type"])
+            metrics.incr("llm_structured_output_rejected_total", mode=response_format["type"])
+            return self._create(**kwargs)
+
+
+class VLLMBackend(Backend):
+    """vLLM OpenAI-compatible server; reports cached prompt tokens"""
+
+    name = "vllm"
+    capabilities = {
+        "structured_output": ("json_schema", "json_object"),
+        "prefix_caching": True,
+    }
+
+
+class OllamaBackend(Backend):
+    """Ollama's native /api/chat endpoint"""
+
+    name = "ollama"
+    capabilities = {
+        "structured_output": ("json_schema", "json_object"),
+        "prefix_caching": True,
+    }
+
+    def __init__(self, base_url, api_key=None, max_retries=2):
+        # Accept the same OPENAI_BASE_URL as the /v1 adapter
+        base_url = base_url.rstrip("/")
+        if base_url.endswith("/v1"):
+            base_url = base_url[:-3]
+        self.base_url = base_url
+        self.api_key = api_key
+        self._unsupported = set()
+
+    def _health_url(self):
+        return f"{self.base_url}/api/tags"
+
+    def warm_up(self, model):
+        """Load model and pin it in memory for OLLAMA_KEEP_ALIVE; an empty chat only loads the model"""
+        response = http_client().post(f"{self.base_url}/api/chat", json={
+            "model": model,
+            "messages": [],
+            "keep_alive": os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+        })
+        response.raise_for_status()
+
+    @staticmethod
+    def _message(message):
+        """OpenAI content parts -> Ollama's text content plus bare base64 images"""
+        content = message.get("content")
+        if not isinstance(content, list):
+            return {"role": message["role"], "content": content or ""}
+
+        texts, images = [], []
+        for part in content:
+            if part.get("type") == "text":
+                texts.append(part["text"])
+            elif part.get("type") == "image_url":
+                url = part["image_url"]["url"]
+                images.append(url.split(",", 1)[1] if url.startswith("data:") else url)
+        converted = {"role": message["role"], "content": "\n\n".join(texts)}
+        if images:
+            converted["images"] = images
+        return converted
+
+    def _create(self, model, messages, response_format=None, temperature=None, max_tokens=None, **kwargs):
+        from openai import BadRequestError
+        from openai.types.chat import ChatCompletion
+
+        options = {}
+        if temperature is not None:
+            options["temperature"] = temperature
+        if max_tokens is not None:
+            options["num_predict"] = max_tokens
+        if os.getenv("OLLAMA_NUM_CTX"):
+            options["num_ctx"] = int(os.getenv("OLLAMA_NUM_CTX"))
+
+        payload = {
+            "model": model,
+            "messages": [self._message(message) for message in messages],
+            "stream": False,
+            "keep_alive": os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+            "options": options,
+        }
+        if response_format is not None:
+            if response_format["type"] == "json_schema":
+                payload["format"] = response_format["json_schema"]["schema"]
+            else:
+                payload["format"] = "json"
+
+        response = http_client().post(f"{self.base_url}/api/chat", json=payload)
+        if response.status_code == 400:
+            raise BadRequestError(response.text, response=response, body=None)
+        response.raise_for_status()
+        data = response.json()
+
+        prompt_tokens = data.get("prompt_eval_count") or 0
+        completion_tokens = data.get("eval_count") or 0
+        return ChatCompletion.model_validate({
+            "id": f"ollama-{time.time_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": data.get("model", model),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": data.get("message", {}).get("content", "")},
+                "finish_reason": "length" if data.get("done_reason") == "length" else "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        })
+
+
+BACKENDS = {
+    "openai": Backend,
+    "ollama": OllamaBackend,
+    "vllm": VLLMBackend,
+}
+
+
+def _is_node_failure(error):
+    """Errors that say the server is unreachable or broken, as opposed to a bad request"""
+    import httpx
+    from openai import APIConnectionError, InternalServerError
+
+    if isinstance(error, (APIConnectionError, InternalServerError, httpx.TransportError)):
+        return True
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code >= 500
+
+
+@contextmanager
+def sticky_routing(key=None):
+    """
+    Route every model call in the block to the same pool server. Nested
+    blocks without an explicit key keep the outer key.
+    """
+    if key is None and _routing_key.get() is not None:
+        yield
+        return
+    token = _routing_key.set(key or uuid.uuid4().hex)
+    try:
+        yield
+    finally:
+        _routing_key.reset(token)
+
+
+class _Node:
+    def __init__(self, backend):
+        self.backend = backend
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+
+class BackendPool:
+    """
+    Several backends of one type behind the Backend.chat() interface.
+
+    POOL_EJECT_AFTER consecutive failures (connection errors, 5xx, failed
+    health checks) eject a server for POOL_EJECT_SECONDS; afterwards it gets
+    traffic again and a passing health check re-admits it early. A request
+    that fails on one server is retried once on another.
+    """
+
+    name = "pool"
+
+    def __init__(self, backends):
+        self.nodes = [_Node(backend) for backend in backends]
+        self._lock = threading.Lock()
+        self._sticky = OrderedDict()
+        self._turn = 0
+        self._health_thread = None
+        self._hedge_executor = None
+        self._hedge_eligible = 0
+        self._hedges = 0
+
+    def __repr__(self):
+        return f"BackendPool({', '.join(node.backend.base_url for node in self.nodes)})"
+
+    @property
+    def capabilities(self):
+        return self.nodes[0].backend.capabilities
+
+    def _acquire(self, key, exclude):
+        now = time.monotonic()
+        with self._lock:
+            candidates = [node for node in self.nodes if node not in exclude and node.ejected_until <= now]
+            if not candidates:
+                # Everything is ejected: try the server that comes back first
+                remaining = [node for node in self.nodes if node not in exclude] or self.nodes
+                candidates = [min(remaining, key=lambda node: node.ejected_until)]
+
+            node = self._sticky.get(key) if key is not None else None
+            if node in candidates:
+                self._sticky.move_to_end(key)
+            else:
+                # Least outstanding requests; ties rotate so idle servers share the load
+                self._turn += 1
+                size = len(self.nodes)
+                node = min(candidates, key=lambda n: (n.outstanding, (self.nodes.index(n) - self._turn) % size))
+                if key is not None:
+                    self._sticky[key] = node
+                    while len(self._sticky) > int(os.getenv("POOL_STICKY_SIZE", "4096")):
+                        self._sticky.popitem(last=False)
+
+            node.outstanding += 1
+            return node
+
+    def _record(self, node, ok):
+        """Count a success or failure against a server, ejecting or re-admitting it"""
+        now = time.monotonic()
+        with self._lock:
+            if ok:
+                if node.ejected_until > now or node.failures:
+                    logger.info(f"Backend {node.backend.base_url} is healthy again")
+                    metrics.incr("llm_pool_readmissions_total", backend=node.backend.base_url)
+                node.failures = 0
+                node.ejected_until = 0.0
+                return
+
+            node.failures += 1
+            if node.failures >= int(os.getenv("POOL_EJECT_AFTER", "3")) and node.ejected_until <= now:
+                node.ejected_until = now + float(os.getenv("POOL_EJECT_SECONDS", "30"))
+                logger.warning(f"Ejecting backend {node.backend.base_url} after {node.failures} failures")
+                metrics.incr("llm_pool_ejections_total", backend=node.backend.base_url)
+
+    def _send(self, node, response_format, kwargs):
+        """One attempt on an acquired server; releases it and records the outcome"""
+        metrics.incr("llm_pool_requests_total", backend=node.backend.base_url)
+        started = time.perf_counter()
+        try:
+            response = node.backend.request(response_format=response_format, **kwargs)
+        except Exception as e:
+            with self._lock:
+                node.outstanding -= 1
+            if _is_node_failure(e):
+                self._record(node, ok=False)
+            raise
+
+        with self._lock:
+            node.outstanding -= 1
+        self._record(node, ok=True)
+        metrics.observe("llm_pool_request_seconds", time.perf_counter() - started, model=kwargs.get("model"))
+        return response
+
+    def _chat(self, response_format, kwargs, node, key, tried=()):
+        """Send on node, failing over once to another server if it is down"""
+        tried = list(tried)
+        while True:
+            try:
+                return self._send(node, response_format, kwargs)
+            except Exception as e:
+                tried.append(node)
+                if not _is_node_failure(e) or len(tried) >= min(2, len(self.nodes)):
+                    raise
+                logger.warning(f"Backend {node.backend.base_url} failed ({e}), retrying on another server")
+                metrics.incr("llm_pool_failovers_total")
+                node = self._acquire(key, tried)
+
+    def chat(self, response_format=None, hedge=False, **kwargs):
+        self._start_health_checks()
+        # One slot per call, however many servers a hedge or failover touches
+        with model_slot():
+            key = _routing_key.get()
+            node = self._acquire(key, [])
+            if hedge and len(self.nodes) > 1 and os.getenv("LLM_HEDGE", "off") == "on":
+                return self._hedged_chat(response_format, kwargs, node, key)
+            return self._chat(response_format, kwargs, node, key)
+
+    def _hedge_delay(self, model):
+        """Seconds to wait before hedging, or None until there are enough latency samples"""
+        samples = metrics.sample_count("llm_pool_request_seconds", model=model)
+        if samples < int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20")):
+            return None
+        quantile = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+        delay = metrics.percentile("llm_pool_request_seconds", quantile, model=model)
+        return max(delay, float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5")))
+
+    def _take_hedge_budget(self):
+        budget = float(os.getenv("LLM_HEDGE_BUDGET_PERCENT", "5")) / 100
+        with self._lock:
+            if self._hedges + 1 > self._hedge_eligible * budget:
+                return False
+            self._hedges += 1
+            return True
+
+    def _executor(self):
+        with self._lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(
+                    max_workers=int(os.getenv("LLM_HEDGE_THREADS", "16")), thread_name_prefix="llm-hedge"
+                )
+            return self._hedge_executor
+
+    def _hedged_chat(self, response_format, kwargs, node, key):
+        """
+        Send on node; if no answer after the hedge delay, send a duplicate to
+        another server and return whichever succeeds first. A request that is
+        already running cannot be interrupted through the synchronous client,
+        so the losing one is left to finish and its answer is dropped.
+        """
+        with self._lock:
+            self._hedge_eligible += 1
+        metrics.incr("llm_hedge_eligible_total")
+        delay = self._hedge_delay(kwargs.get("model"))
+        if delay is None:
+            return self._chat(response_format, kwargs, node, key)
+
+        primary = self._executor().submit(self._chat, response_format, kwargs, node, key)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+
+        if not self._take_hedge_budget():
+            metrics.incr("llm_hedges_skipped_total", reason="budget")
+            return primary.result()
+
+        hedge_node = self._acquire(None, [node])
+        logger.info(f"Hedging request after {delay:.2f}s: {node.backend.base_url} -> {hedge_node.backend.base_url}")
+        metrics.incr("llm_hedges_total")
+        hedge = self._executor().submit(self._chat, response_format, kwargs, hedge_node, None, [node])
+
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        metrics.incr("llm_hedge_wins_total")
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def check_health(self):
+        """Probe every server once"""
+        for node in self.nodes:
+            self._record(node, node.backend.health_check(float(os.getenv("POOL_HEALTH_TIMEOUT", "2"))))
+
+    def _health_loop(self):
+        interval = float(os.getenv("POOL_HEALTH_INTERVAL", "10"))
+        while True:
+            time.sleep(interval)
+            try:
+                self.check_health()
+            except Exception as e:
+                logger.error(f"Backend health check failed: {e}")
+
+    def _start_health_checks(self):
+        if self._health_thread is not None:
+            return
+        with self._lock:
+            if self._health_thread is None:
+                self._health_thread = threading.Thread(target=self._health_loop, name="llm-health", daemon=True)
+                self._health_thread.start()
+
+    def warm_up(self, model):
+        """Warm model on every server; fails only when no server could load it"""
+        warmed = 0
+        error = None
+        for node in self.nodes:
+            try:
+                node.backend.warm_up(model)
+                warmed += 1
+            except Exception as e:
+                logger.warning(f"Warm-up of {model} on {node.backend.base_url} failed: {e}")
+                error = e
+        if not warmed:
+            raise error
+
+    def status(self):
+        """Per-server routing state for /metrics"""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "base_url": node.backend.base_url,
+                    "outstanding": node.outstanding,
+                    "failures": node.failures,
+                    "ejected": node.ejected_until > now,
+                }
+                for node in self.nodes
+            ]
+
+
+def _backend_class():
+    kind = os.getenv("LLM_BACKEND", "openai")
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown LLM_BACKEND: {kind}")
+    return kind, BACKENDS[kind]
+
+
+def get_pool():
+    """Return the BackendPool over OPENAI_BASE_URLS, or None when not configured"""
+    urls = tuple(url.strip() for url in os.getenv("OPENAI_BASE_URLS", "").split(",") if url.strip())
+    if not urls:
+        return None
+
+    kind, backend_class = _backend_class()
+    key = (kind, urls)
+    pool = _pools.get(key)
+    if pool is None:
+        # The pool fails over itself, so the OpenAI client's own retries are off
+        pool = BackendPool([backend_class(url, os.getenv("OPENAI_API_KEY"), max_retries=0) for url in urls])
+        with _lock:
+            pool = _pools.setdefault(key, pool)
+        logger.info(f"Using {kind} backend pool: {', '.join(urls)}")
+    return pool
+
+
+def get_backend(base_url=None):
+    """
+    Return the adapter for base_url, or by default the OPENAI_BASE_URLS pool
+    when configured and the OPENAI_BASE_URL adapter otherwise.
+    """
+    if base_url is None:
+        pool = get_pool()
+        if pool is not None:
+            return pool
+        base_url = os.getenv("OPENAI_BASE_URL")
+
+    kind, backend_class = _backend_class()
+    key = (kind, base_url)
+    backend = _backends.get(key)
+    if backend is None:
+        backend = backend_class(base_url, os.getenv("OPENAI_API_KEY"))
+        with _lock:
+            backend = _backends.setdefault(key, backend)
+        logger.info(f"Using {kind} backend at {base_url} (model {os.getenv('OPENAI_MODEL')})")
+    return backend
@@ -0,0 +1,258 @@
+"""
+Rule-based extraction of regular fields from the PDF text layer.
+
+Emails, mobile/phone/fax numbers, PIN codes, letter dates and reference
+numbers have regular formats, so compiled regex banks find them without
+spending model tokens. Each hit carries a confidence score: fields found
+with high confidence are dropped from the model request, lower-confidence
+hits only fill gaps the model leaves. Letter dates are returned as
+YYYY-MM-DD (numeric dates read day first); dates that do not exist are
+dropped.
+
+Text comes from poppler's pdftotext (installed with poppler-utils alongside
+pdf2image); scanned PDFs without a text layer simply yield no rule hits.
+Set LOCAL_EXTRACTION=off to disable the stage.
+"""
+import os
+import re
+import subprocess
+from datetime import date
+
+from config import logger
+import metrics
+
+# Schema fields the rules know how to fill
+LOCAL_FIELDS = ("email", "mobile", "phone", "fax", "pincode", "letterDate", "letterRefNo")
+
+# Sender contact fields should come from the signature block / footer, which
+# sit at the end of a letter: hits there score higher than hits elsewhere
+SENDER_CONTACT_FIELDS = ("email", "mobile", "phone", "fax", "pincode")
+
+_MONTHS = (r"(?:Jan(?:uary)?|Feb(?:ruary)?|Mar(?:ch)?|Apr(?:il)?|May|June?|July?|Aug(?:ust)?|"
+           r"Sep(?:t(?:ember)?)?|Oct(?:ober)?|Nov(?:ember)?|Dec(?:ember)?)")
+
+_DATE = (r"(?:\d{1,2}[./-]\d{1,2}[./-](?:\d{4}|\d{2})"
+         r"|\d{1,2}(?:st|nd|rd|th)?\s+" + _MONTHS + r"\.?,?\s+\d{4}"
+         r"|" + _MONTHS + r"\.?\s+\d{1,2}(?:st|nd|rd|th)?,?\s+\d{4}"
+         r"|\d{4}-\d{2}-\d{2})")
+
+# Obfuscated addresses common on government letterheads: name[at]nic[dot]in
+_EMAIL_AT = re.compile(r"\s*[\[\(\{]\s*at\s*[\]\)\}]\s*", re.IGNORECASE)
+_EMAIL_DOT = re.compile(r"\s*[\[\(\{]\s*dot\s*[\]\)\}]\s*", re.IGNORECASE)
+
+EMAIL_RE = re.compile(r"(?<![\w.+-])([A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,})")
+MOBILE_RE = re.compile(r"(?<![\d+])(?:\+91[\s-]?|91[\s-]|0)?([6-9]\d{4})[\s-]?(\d{5})(?!\d)")
+LANDLINE_RE = re.compile(r"(?<![\d+])(?:\+91[\s-]?)?\(?(0?[1-9]\d{1,3})\)?[\s-](\d{6,8})(?!\d)")
+PHONE_LABEL_RE = re.compile(r"\b(?:Tel(?:ephone)?|Ph(?:one)?|Off(?:ice)?\.?\s*Ph)\b\.?\s*(?:No\.?)?\s*[:\-]?", re.IGNORECASE)
+MOBILE_LABEL_RE = re.compile(r"\b(?:Mob(?:ile)?|Cell|M)\b\.?\s*(?:No\.?)?\s*[:\-]?", re.IGNORECASE)
+FAX_LABEL_RE = re.compile(r"\bFax\b\.?\s*(?:No\.?)?\s*[:\-]?", re.IGNORECASE)
+EMAIL_LABEL_RE = re.compile(r"\bE-?mail\b\s*(?:ID|Id|id)?\s*[:\-]?", re.IGNORECASE)
+PINCODE_LABELLED_RE = re.compile(r"\bPIN(?:\s*Code)?\b\.?\s*[:\-]?\s*([1-9]\d{2})\s?(\d{3})(?!\d)", re.IGNORECASE)
+PINCODE_ADDRESS_RE = re.compile(r"[A-Za-z)]\s*[-–,]\s*([1-9]\d{2})\s?(\d{3})(?!\d)")
+# "Dated:" as its own column of the header, not "letter dated ..." in the body
+DATE_LABELLED_RE = re.compile(r"(?:^\s*|\s{2,})(?:Dated|Date|Dt)\b\.?\s*[:\-]?\s*(" + _DATE + r")", re.IGNORECASE)
+DATE_RE = re.compile(r"(?<!\d)(" + _DATE + r")")
+# A bare "No." (without Ref/File/Letter/D.O.) also starts prose ("No objection ..."),
+# so it needs its "." or ":" and only counts as a weaker, unlabelled hit
+REF_NO_RE = re.compile(
+    r"^\s*(?:(?P<label>Ref(?:erence)?\.?\s*No|F(?:ile)?\.?\s*No|Letter\s*No|D\.?O\.?\s*(?:Letter\s*)?No)\b\.?\s*[:\-]?"
+    r"|No\s*[.:]\s*[:\-]?)\s*"
+    r"(?P<value>[A-Z0-9][\w./()\-]*(?:[ /][\w./()\-]+)*?)(?=\s{2,}|\s+(?:Dated|Date|Dt)\b|\s*$)",
+    re.IGNORECASE | re.MULTILINE,
+)
+# Reference numbers carry a number or a "/"-separated file code
+_REF_NO_VALUE_RE = re.compile(r"[\d/]")
+_MONTH_NUMBERS = {name: number for number, name in enumerate(
+    ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"), start=1)}
+_NUMERIC_DATE_RE = re.compile(r"(\d{1,2})[./-](\d{1,2})[./-](\d{4}|\d{2})$")
+_DAY_MONTH_DATE_RE = re.compile(r"(\d{1,2})(?:st|nd|rd|th)?\s+([A-Za-z]+)\.?,?\s+(\d{4})$")
+_MONTH_DAY_DATE_RE = re.compile(r"([A-Za-z]+)\.?\s+(\d{1,2})(?:st|nd|rd|th)?,?\s+(\d{4})$")
+_ISO_DATE_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})$")
+
+
+def local_extraction_enabled():
+    return os.getenv("LOCAL_EXTRACTION", "on") != "off"
+
+
+def pdf_text_pages(pdf_path):
+    """Return the text layer of each page, or [] if pdftotext is missing or fails"""
+    try:
+        result = subprocess.run(
+            ["pdftotext", "-layout", "-enc", "UTF-8", pdf_path, "-"],
+            capture_output=True, timeout=int(os.getenv("PDFTOTEXT_TIMEOUT", "30")),
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"Could not read PDF text layer: {e}")
+        return []
+    if result.returncode != 0:
+        logger.warning(f"pdftotext failed ({result.returncode}): {result.stderr.decode('utf-8', 'replace')[:200]}")
+        return []
+
+    pages = result.stdout.decode("utf-8", "replace").split("\f")
+    # pdftotext terminates the last page with a form feed as well
+    if pages and not pages[-1].strip():
+        pages = pages[:-1]
+    return pages
+
+
+def _normalize_mobile(match):
+    return match.group(1) + match.group(2)
+
+
+def _normalize_landline(match):
+    std_code = match.group(1)
+    if not std_code.startswith("0"):
+        std_code = "0" + std_code
+    return f"{std_code}-{match.group(2)}"
+
+
+def _iso_date(text):
+    """
+    A matched date as YYYY-MM-DD, reading numeric dates day first
+    (12.03.2024 is 12 March) and two-digit years as 20xx. None when the
+    date does not exist.
+    """
+    text = text.strip()
+    match = _ISO_DATE_RE.match(text)
+    if match:
+        year, month, day = (int(part) for part in match.groups())
+    elif _NUMERIC_DATE_RE.match(text):
+        day, month, year = (int(part) for part in _NUMERIC_DATE_RE.match(text).groups())
+        year += 2000 if year < 100 else 0
+    else:
+        match = _DAY_MONTH_DATE_RE.match(text)
+        if match:
+            day, month_name, year = match.groups()
+        else:
+            match = _MONTH_DAY_DATE_RE.match(text)
+            if not match:
+                return None
+            month_name, day, year = match.groups()
+        month = _MONTH_NUMBERS.get(month_name[:3].lower())
+        day, year = int(day), int(year)
+    try:
+        return date(year, month, day).isoformat()
+    except (TypeError, ValueError):
+        return None
+
+
+def _labelled_value(line, label_re, value_re, normalize):
+    """Value matched right after a label on the same line, e.g. 'Fax: 011-23456789'"""
+    label = label_re.search(line)
+    if not label:
+        return None
+    match = value_re.search(line, label.end())
+    if not match or match.start() - label.end() > 6:
+        return None
+    return normalize(match)
+
+
+def _candidates(pages):
+    """
+    Yield (field, value, labelled, position) for every rule hit, where
+    position is the hit's relative location in the document (0.0-1.0).
+    """
+    lines = []
+    for page_index, page_text in enumerate(pages):
+        for line in page_text.splitlines():
+            if line.strip():
+                lines.append((page_index, line))
+    total = max(len(lines), 1)
+
+    for line_index, (page_index, line) in enumerate(lines):
+        position = line_index / total
+        email_line = _EMAIL_DOT.sub(".", _EMAIL_AT.sub("@", line))
+
+        labelled_email = EMAIL_LABEL_RE.search(email_line) is not None
+        for match in EMAIL_RE.finditer(email_line):
+            yield "email", match.group(1).lower().rstrip("."), labelled_email, position
+
+        fax = _labelled_value(line, FAX_LABEL_RE, LANDLINE_RE, _normalize_landline)
+        if fax:
+            yield "fax", fax, True, position
+
+        mobile = _labelled_value(line, MOBILE_LABEL_RE, MOBILE_RE, _normalize_mobile)
+        if mobile:
+            yield "mobile", mobile, True, position
+        elif not FAX_LABEL_RE.search(line):
+            for match in MOBILE_RE.finditer(line):
+                yield "mobile", _normalize_mobile(match), False, position
+
+        phone = _labelled_value(line, PHONE_LABEL_RE, LANDLINE_RE, _normalize_landline)
+        if phone:
+            yield "phone", phone, True, position
+
+        for match in PINCODE_LABELLED_RE.finditer(line):
+            yield "pincode", match.group(1) + match.group(2), True, position
+        for match in PINCODE_ADDRESS_RE.finditer(line):
+            yield "pincode", match.group(1) + match.group(2), False, position
+
+        # The letter's own date and reference number are on the first page
+        if page_index == 0:
+            for match in DATE_LABELLED_RE.finditer(line):
+                yield "letterDate", _iso_date(match.group(1)), True, position
+            for match in DATE_RE.finditer(line):
+                yield "letterDate", _iso_date(match.group(1)), False, position
+            for match in REF_NO_RE.finditer(line):
+                ref_no = match.group("value").strip(" .,:-")
+                if _REF_NO_VALUE_RE.search(ref_no):
+                    yield "letterRefNo", ref_no, match.group("label") is not None, position
+
+
+def _score(field, value, labelled, position, distinct_values):
+    """Confidence for one candidate given how it was found and how many competitors it has"""
+    if field == "letterDate":
+        score = 0.9 if labelled else 0.55
+    elif field == "letterRefNo":
+        score = 0.85 if labelled else 0.7
+    else:
+        score = 0.8 if labelled else 0.6
+
+    if field in SENDER_CONTACT_FIELDS and position >= 0.66:
+        score += 0.1
+    if distinct_values > 1:
+        score -= 0.2
+    return round(max(0.0, min(score, 0.99)), 2)
+
+
+def extract_fields(pages, fields=None):
+    """
+    Run the rule banks over page texts. Returns {field: (value, confidence)}
+    with the best candidate per field, limited to the requested fields.
+    """
+    wanted = set(fields) if fields is not None else set(LOCAL_FIELDS)
+    wanted &= set(LOCAL_FIELDS)
+    if not wanted or not pages:
+        return {}
+
+    hits = {}
+    for field, value, labelled, position in _candidates(pages):
+        if field in wanted and value:
+            hits.setdefault(field, []).append((value, labelled, position))
+
+    results = {}
+    for field, candidates in hits.items():
+        # Labelled hits only compete with other labelled hits
+        distinct_labelled = len({value for value, labelled, _ in candidates if labelled})
+        distinct_all = len({value for value, _, _ in candidates})
+        scored = [
+            (_score(field, value, labelled, position, distinct_labelled if labelled else distinct_all), position, value)
+            for value, labelled, position in candidates
+        ]
+        if field in SENDER_CONTACT_FIELDS:
+            # Ties go to the later hit (signature block / footer)
+            best = max(scored, key=lambda item: (item[0], item[1]))
+        else:
+            # Ties go to the earlier hit (letter header)
+            best = max(scored, key=lambda item: (item[0], -item[1]))
+        results[field] = (best[2], best[0])
+        metrics.incr("local_extractor_hits_total", field=field)
+
+    return results
+
+
+def confident_fields(rule_fields, min_confidence=None):
+    """Fields whose rule confidence is high enough to skip asking the model"""
+    if min_confidence is None:
+        min_confidence = float(os.getenv("LOCAL_EXTRACTION_MIN_CONFIDENCE", "0.85"))
+    return {field for field, (_, confidence) in rule_fields.items() if confidence >= min_confidence}
@@ -0,0 +1,119 @@
+"""
+In-process metrics for the model calling code paths.
+
+Counters and latency samples live in this process only (every uvicorn worker
+keeps its own) and are exposed as JSON by the /metrics endpoint. Labels are
+folded into the metric key, e.g. llm_prompt_tokens_total{operation=extraction}.
+"""
+import threading
+from collections import defaultdict, deque
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_samples = defaultdict(lambda: deque(maxlen=1024))
+
+# Derived ratios reported by snapshot(): name -> (numerator counter, denominator counter)
+_ratios = {
+    "prefix_cache_hit_rate": ("llm_cached_prompt_tokens_total", "llm_prompt_tokens_total"),
+    "json_parse_failure_rate": ("llm_json_parse_failures_total", "llm_json_responses_total"),
+    "json_cleanup_rate": ("llm_json_cleanups_total", "llm_json_responses_total"),
+    "cascade_escalation_rate": ("cascade_escalations_total", "cascade_small_pages_total"),
+    "hedge_rate": ("llm_hedges_total", "llm_hedge_eligible_total"),
+    "hedge_win_rate": ("llm_hedge_wins_total", "llm_hedges_total"),
+}
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    label_str = ",".join(f"{k}={v}" for k, v in sorted(labels.items()))
+    return f"{name}{{{label_str}}}"
+
+
+def incr(name, value=1, **labels):
+    """Increase a counter"""
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def observe(name, value, **labels):
+    """Record a sample (e.g. a latency in seconds) for percentile reporting"""
+    with _lock:
+        _samples[_key(name, labels)].append(value)
+
+
+def percentile(name, q, **labels):
+    """Return the q-quantile (0.0-1.0) of recent samples, or None without samples"""
+    with _lock:
+        values = sorted(_samples.get(_key(name, labels), ()))
+    if not values:
+        return None
+    index = min(len(values) - 1, int(q * len(values)))
+    return values[index]
+
+
+def sample_count(name, **labels):
+    """Number of recent samples kept for a metric"""
+    with _lock:
+        return len(_samples.get(_key(name, labels), ()))
+
+
+def record_usage(response, operation, **labels):
+    """
+    Record token usage reported by an OpenAI-compatible backend. Prefix cache
+    hits come from usage.prompt_tokens_details.cached_tokens (vLLM, llama.cpp
+    server); backends that do not report it count as zero cached tokens.
+    Prefilled tokens are the prompt tokens the backend had to compute,
+    i.e. prompt minus cached tokens. Extra labels (e.g. output="sparse") split the counters further.
+    """
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        incr("llm_usage_missing_total", operation=operation, **labels)
+        return
+
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+    completion_tokens = getattr(usage, "completion_tokens", None) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+
+    incr("llm_requests_total", operation=operation, **labels)
+    incr("llm_prompt_tokens_total", prompt_tokens, operation=operation, **labels)
+    incr("llm_cached_prompt_tokens_total", cached_tokens, operation=operation, **labels)
+    incr("llm_prefill_tokens_total", prompt_tokens - cached_tokens, operation=operation, **labels)
+    incr("llm_completion_tokens_total", completion_tokens, operation=operation, **labels)
+    observe("llm_prefill_tokens", prompt_tokens - cached_tokens, operation=operation, **labels)
+    observe("llm_completion_tokens", completion_tokens, operation=operation, **labels)
+
+
+def _summarize_samples(values):
+    values = sorted(values)
+    count = len(values)
+    return {
+        "count": count,
+        "mean": sum(values) / count,
+        "p50": values[min(count - 1, int(0.50 * count))],
+        "p95": values[min(count - 1, int(0.95 * count))],
+        "p99": values[min(count - 1, int(0.99 * count))],
+        "max": values[-1],
+    }
+
+
+def snapshot():
+    """Return counters, sample distributions (latencies, token counts) and derived ratios"""
+    with _lock:
+        counters = dict(_counters)
+        samples = {key: list(values) for key, values in _samples.items() if values}
+
+    ratios = {}
+    for ratio_name, (numerator, denominator) in _ratios.items():
+        for key, total in counters.items():
+            if not (key == denominator or key.startswith(denominator + "{")) or not total:
+                continue
+            label_suffix = key[len(denominator):]
+            ratios[ratio_name + label_suffix] = round(counters.get(numerator + label_suffix, 0) / total, 4)
+
+    return {
+        "counters": counters,
+        "distributions": {key: _summarize_samples(values) for key, values in samples.items()},
+        "ratios": ratios,
+    }
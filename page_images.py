@@ -0,0 +1,186 @@
+"""
+Cached page images of stored documents.
+
+get_page_image() renders page N of a document at a requested width with the
+same pdf2image/poppler machinery as pdf_to_base64_images, only for that one
+page, and keeps the result on disk under PAGE_CACHE_DIR (default
+cache/pages). Entries are keyed by the document's content hash, so
+deduplicated uploads share them, and are evicted least recently used first
+(by file mtime, refreshed on every hit) once the cache exceeds
+PAGE_CACHE_MB (default 512).
+
+cached_json() keeps other derived data of a document in the same cache and
+under the same quota (e.g. the rendered pages sent to the model, the text
+layer, pre-computed extraction results), keyed by content hash as well.
+
+Rendering is blocking and CPU heavy: callers run it in a worker thread,
+and at most PAGE_RENDER_CONCURRENCY (default 2) pages render at once per
+worker.
+"""
+import json
+import os
+import threading
+import uuid
+from io import BytesIO
+
+from config import logger
+import metrics
+
+IMAGE_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+MIN_WIDTH, MAX_WIDTH = 32, 2000
+
+_lock = threading.Lock()
+_key_locks = [threading.Lock() for _ in range(64)]  # striped by cache key
+_render_slots = None
+_cache_bytes = None  # running estimate; None until the first scan
+
+
+class PageNotFound(Exception):
+    pass
+
+
+def cache_dir():
+    return os.getenv("PAGE_CACHE_DIR", os.path.join("cache", "pages"))
+
+
+def _render_semaphore():
+    global _render_slots
+    with _lock:
+        if _render_slots is None:
+            _render_slots = threading.BoundedSemaphore(int(os.getenv("PAGE_RENDER_CONCURRENCY", "2")))
+        return _render_slots
+
+
+def _key_lock(key):
+    return _key_locks[hash(key) % len(_key_locks)]
+
+
+def cache_key(document, page, width, image_format):
+    content = document["sha256"] or f"doc-{document['doc_id']}"
+    return f"{content}-p{page}-w{width}.{image_format}"
+
+
+def render_page(pdf_path, page, width, image_format="png"):
+    """Render one page (1-based) scaled to width pixels; returns the encoded image bytes"""
+    from pdf2image import convert_from_path  # pulls in PIL; only needed when rendering
+
+    images = convert_from_path(pdf_path, first_page=page, last_page=page, size=(width, None))
+    if not images:
+        raise PageNotFound(f"Page {page} not found")
+    buffered = BytesIO()
+    image = images[0]
+    if image_format == "jpeg" and image.mode != "RGB":
+        image = image.convert("RGB")
+    image.save(buffered, format=IMAGE_FORMATS[image_format])
+    return buffered.getvalue()
+
+
+def _cache_path(key):
+    return os.path.join(cache_dir(), key[:2], key)
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial_path = f"{path}.{uuid.uuid4().hex[:8]}.part"
+    with open(partial_path, "wb") as f:
+        f.write(data)
+    os.replace(partial_path, path)
+
+
+def _scan():
+    """Cached files as [(mtime, size, path)], oldest first"""
+    entries = []
+    for root, _, files in os.walk(cache_dir()):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    return entries
+
+
+def _evict(added_bytes):
+    """Account for a new entry and evict least recently used entries while over the quota"""
+    global _cache_bytes
+    quota = float(os.getenv("PAGE_CACHE_MB", "512")) * 1024 * 1024
+    with _lock:
+        if _cache_bytes is not None:
+            _cache_bytes += added_bytes
+            if _cache_bytes <= quota:
+                return
+        entries = _scan()
+        _cache_bytes = sum(size for _, size, _ in entries)
+        # Evict down to 90% so the next few renders do not each trigger a scan
+        for _, size, path in entries:
+            if _cache_bytes <= quota * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            _cache_bytes -= size
+            metrics.incr("page_cache_evictions_total")
+
+
+def get_page_image(document, page, width=200, image_format="png"):
+    """
+    Path of the cached image of a document page, rendering it on a miss.
+    Raises PageNotFound when the page does not exist.
+    """
+    key = cache_key(document, page, width, image_format)
+    path = _cache_path(key)
+    with _key_lock(key):  # concurrent requests for the same page render it once
+        if os.path.exists(path):
+            try:
+                os.utime(path)
+                metrics.incr("page_cache_hits_total", kind="image")
+                return path
+            except FileNotFoundError:
+                pass  # evicted meanwhile
+
+        metrics.incr("page_cache_misses_total", kind="image")
+        with _render_semaphore():
+            image = render_page(document["file_path"], page, width, image_format)
+
+        _write(path, image)
+        logger.debug(f"Rendered page {page} of {document['doc_id']} at {width}px ({len(image)} bytes)")
+
+    _evict(len(image))
+    return path
+
+
+def get_json(key):
+    """Cached value for key, or None"""
+    path = _cache_path(key)
+    try:
+        with open(path, "rb") as f:
+            value = json.loads(f.read())
+        os.utime(path)
+    except (FileNotFoundError, ValueError):
+        metrics.incr("page_cache_misses_total", kind="json")
+        return None
+    metrics.incr("page_cache_hits_total", kind="json")
+    return value
+
+
+def put_json(key, value):
+    data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+    _write(_cache_path(key), data)
+    _evict(len(data))
+
+
+def cached_json(key, compute):
+    """
+    Cached value for key, else compute() stored under key. Empty results
+    (e.g. no text layer) are returned but not stored.
+    """
+    with _key_lock(key):  # a page set being rendered in the background is not rendered twice
+        value = get_json(key)
+        if value is None:
+            value = compute()
+            if value:
+                put_json(key, value)
+    return value
@@ -0,0 +1,266 @@
+"""
+Indian PIN code -> district / state / city lookup.
+
+Two sources, loaded lazily on first lookup:
+
+1. A PIN code directory CSV (columns pincode, districtname/district,
+   statename/state and optionally city/taluk; header names are matched
+   case-insensitively). Rows are collapsed to one entry per PIN code and
+   kept in parallel arrays (sorted PIN codes plus indexes into de-duplicated
+   name tables), so the full post office directory (~19k codes) takes a few
+   hundred KB and lookups are a binary search. Point PINCODE_DATA_PATH at an
+   export of it; by default the compact bundled data/pincodes.csv is used,
+   which covers the head offices of state capitals and major cities, and
+   the codes of the prefixes shared between states that it knows.
+2. A bundled table of postal circles by the first three digits, which gives
+   the state for almost every PIN code. Prefixes shared between states
+   (e.g. 244/247 Uttar Pradesh and Uttarakhand, 533/609/673 with the
+   Puducherry enclaves, 362 Gujarat and Diu) are left out rather than
+   guessed.
+"""
+import csv
+import os
+import threading
+from array import array
+from bisect import bisect_left
+
+from config import logger
+
+COUNTRY = "India"
+BUNDLED_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "pincodes.csv")
+
+# First three digits -> state/UT, as (first prefix, last prefix, state) ranges
+_PREFIX_RANGES = (
+    (110, 110, "Delhi"),
+    (121, 136, "Haryana"),
+    (140, 159, "Punjab"),
+    (171, 177, "Himachal Pradesh"),
+    (180, 193, "Jammu and Kashmir"),
+    (194, 194, "Ladakh"),
+    (201, 243, "Uttar Pradesh"),
+    (245, 245, "Uttar Pradesh"),
+    (246, 246, "Uttarakhand"),
+    (248, 249, "Uttarakhand"),
+    (250, 261, "Uttar Pradesh"),
+    (263, 263, "Uttarakhand"),
+    (270, 285, "Uttar Pradesh"),
+    (301, 345, "Rajasthan"),
+    (360, 361, "Gujarat"),
+    (363, 395, "Gujarat"),
+    (400, 402, "Maharashtra"),
+    (403, 403, "Goa"),
+    (404, 445, "Maharashtra"),
+    (450, 488, "Madhya Pradesh"),
+    (490, 497, "Chhattisgarh"),
+    (500, 509, "Telangana"),
+    (510, 532, "Andhra Pradesh"),
+    (534, 535, "Andhra Pradesh"),
+    (560, 591, "Karnataka"),
+    (600, 604, "Tamil Nadu"),
+    (606, 608, "Tamil Nadu"),
+    (610, 643, "Tamil Nadu"),
+    (670, 672, "Kerala"),
+    (674, 681, "Kerala"),
+    (683, 695, "Kerala"),
+    (700, 736, "West Bengal"),
+    (737, 737, "Sikkim"),
+    (738, 743, "West Bengal"),
+    (744, 744, "Andaman and Nicobar Islands"),
+    (751, 770, "Odisha"),
+    (781, 788, "Assam"),
+    (790, 792, "Arunachal Pradesh"),
+    (793, 794, "Meghalaya"),
+    (795, 795, "Manipur"),
+    (796, 796, "Mizoram"),
+    (797, 798, "Nagaland"),
+    (799, 799, "Tripura"),
+    (800, 812, "Bihar"),
+    (814, 816, "Jharkhand"),
+    (817, 821, "Bihar"),
+    (822, 822, "Jharkhand"),
+    (823, 824, "Bihar"),
+    (825, 835, "Jharkhand"),
+    (841, 855, "Bihar"),
+)
+
+_lock = threading.Lock()
+_directory = None
+
+
+class _Directory:
+    """PIN codes with district/state/city indexes into shared name tables"""
+
+    def __init__(self):
+        self.pincodes = array("I")
+        self.districts = array("H")
+        self.states = array("H")
+        self.cities = array("H")
+        self.names = []
+
+    def __len__(self):
+        return len(self.pincodes)
+
+    def get(self, pincode):
+        index = bisect_left(self.pincodes, pincode)
+        if index == len(self.pincodes) or self.pincodes[index] != pincode:
+            return None
+        return {
+            "district": self.names[self.districts[index]],
+            "state": self.names[self.states[index]],
+            "city": self.names[self.cities[index]],
+        }
+
+
+def _column(header, *candidates):
+    lowered = {name.strip().lower(): index for index, name in enumerate(header)}
+    for candidate in candidates:
+        if candidate in lowered:
+            return lowered[candidate]
+    return None
+
+
+def _load_directory(path):
+    directory = _Directory()
+    name_ids = {}
+
+    def name_id(name):
+        name = " ".join(name.split()).title().replace(" And ", " and ")
+        if name not in name_ids:
+            name_ids[name] = len(directory.names)
+            directory.names.append(name)
+        return name_ids[name]
+
+    rows = {}
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        pin_col = _column(header, "pincode", "pin", "pin code")
+        district_col = _column(header, "districtname", "district")
+        state_col = _column(header, "statename", "state")
+        city_col = _column(header, "city", "taluk", "divisionname")
+        if pin_col is None or district_col is None or state_col is None:
+            raise ValueError(f"{path} needs pincode, district and state columns")
+
+        for row in reader:
+            try:
+                pincode = int(row[pin_col])
+            except (ValueError, IndexError):
+                continue
+            # One entry per PIN code: the first office listed wins
+            if pincode in rows:
+                continue
+            district = row[district_col]
+            city = row[city_col] if city_col is not None and row[city_col].strip() not in ("", "NA") else district
+            rows[pincode] = (name_id(district), name_id(row[state_col]), name_id(city))
+
+    if len(directory.names) > 65535:
+        raise ValueError(f"{path} has too many distinct names for the index")
+
+    for pincode in sorted(rows):
+        district, state, city = rows[pincode]
+        directory.pincodes.append(pincode)
+        directory.districts.append(district)
+        directory.states.append(state)
+        directory.cities.append(city)
+    return directory
+
+
+def _get_directory():
+    """Load the directory CSV on first use; an empty directory when it cannot be read"""
+    global _directory
+    if _directory is not None:
+        return _directory
+
+    with _lock:
+        if _directory is None:
+            path = os.getenv("PINCODE_DATA_PATH") or BUNDLED_DATA_PATH
+            directory = _Directory()
+            try:
+                directory = _load_directory(path)
+                logger.info(f"Loaded {len(directory)} PIN codes from {path}")
+            except Exception as e:
+                logger.error(f"Could not load PIN code directory {path}: {e}")
+            _directory = directory
+    return _directory
+
+
+def _state_for_prefix(prefix):
+    for first, last, state in _PREFIX_RANGES:
+        if first <= prefix <= last:
+            return state
+    return None
+
+
+def lookup(pincode):
+    """
+    Return {"district", "state", "city", "country", "source"} for a PIN code
+    ("source" is "directory" or "prefix"; prefix hits have no district/city),
+    or None for malformed or unknown codes.
+    """
+    digits = "".join(ch for ch in str(pincode or "") if ch.isdigit())
+    if len(digits) != 6 or digits[0] == "0":
+        return None
+
+    entry = _get_directory().get(int(digits))
+    if entry is not None:
+        return {**entry, "country": COUNTRY, "source": "directory"}
+
+    state = _state_for_prefix(int(digits[:3]))
+    if state is None:
+        return None
+    return {"district": None, "state": state, "city": None, "country": COUNTRY, "source": "prefix"}
+
+
+def _schema_value(compiled_schema, field, value):
+    """The value as the schema's validator would store it, None if the field cannot hold it"""
+    validator = compiled_schema.validators.get(field)
+    return validator(value) if validator else value
+
+
+def location_fields(pincode, compiled_schema):
+    """
+    Location fields derived from a PIN code as {field: (value, confidence)},
+    limited to fields of the schema that can hold the value; same shape as
+    the rule extractor results.
+    """
+    location = lookup(pincode)
+    if location is None:
+        return {}
+
+    derived = {}
+    for field, value, confidence in (
+        ("country", location["country"], 0.95),
+        ("state", location["state"], 0.9),
+        ("cityName", location["city"], 0.85),
+    ):
+        if value and field in compiled_schema.expected_fields:
+            schema_value = _schema_value(compiled_schema, field, value)
+            if schema_value is not None:
+                derived[field] = (schema_value, confidence)
+    return derived
+
+
+def fill_location(data, compiled_schema):
+    """
+    Fill missing state/cityName/country from the extracted pincode and
+    correct a state that contradicts it.
+    """
+    location = lookup(data.get("pincode"))
+    if location is None:
+        return data
+
+    data = dict(data)
+    derived = location_fields(data["pincode"], compiled_schema)
+
+    if "state" in derived:
+        state = derived["state"][0]
+        current = data.get("state")
+        if not current:
+            data["state"] = state
+        elif _schema_value(compiled_schema, "state", current) != state:
+            logger.info(f"State {current!r} contradicts pincode {data['pincode']} ({location['state']}); using the pincode")
+            data["state"] = state
+    for field in ("cityName", "country"):
+        if field in derived and not data.get(field):
+            data[field] = derived[field][0]
+    return data
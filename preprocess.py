@@ -0,0 +1,163 @@
+"""
+Upload-time pre-processing.
+
+With PREPROCESS_ON_UPLOAD=on, /upload queues each stored document for
+background work, so a later processing request for the same content finds
+warm caches instead of paying for rendering (and inference) on click:
+
+- the pages are rendered as the extraction endpoints send them to the
+  model (model_page_images);
+- the PDF text layer is read for the rule-based extractors (text_pages);
+- with PREPROCESS_SCHEMA_FILE set to a form schema (JSON), the document is
+  extracted against it; /process-pdf with that schema then answers from
+  the stored result, and the fields are indexed for search.
+
+Results live in the page cache (page_images.cached_json), keyed by content
+hash, so they also serve requests that send the PDF itself rather than a
+documentId. Only catalogued content is cached: pages and text of a PDF that
+was sent inline and never uploaded are computed in memory and not kept. The queue is per worker, holds at most PREPROCESS_QUEUE_SIZE
+documents (further uploads are not pre-processed) and runs
+PREPROCESS_CONCURRENCY (default 1) jobs at a time in worker threads. Its
+model calls run at background priority (see scheduler).
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+
+from config import logger
+import catalog
+import metrics
+import page_images
+import schema_registry
+import scheduler
+from local_extractors import local_extraction_enabled, pdf_text_pages
+
+# Resolution the sequential extractor renders pages at (pdf_to_base64_images default)
+MODEL_PAGE_DPI = 150
+
+_queue = None
+_lock = threading.Lock()
+_status = {"queued": 0, "running": 0}
+_default_schema = {}  # schema file path -> CompiledSchema
+
+
+def enabled():
+    return os.getenv("PREPROCESS_ON_UPLOAD", "off") == "on"
+
+
+def _cached_if_catalogued(key, sha256, compute):
+    """compute() through the page cache for catalogued content, else directly without keeping it"""
+    if not catalog.find_by_hash(sha256):
+        return compute()
+    return page_images.cached_json(key, compute)
+
+
+def model_page_images(pdf_path, sha256):
+    """Pages as base64 data URLs for the extraction model, rendered once per catalogued content"""
+    from qwenmodel_sequential_enhanced import pdf_to_base64_images
+
+    return _cached_if_catalogued(
+        f"{sha256}-pages-dpi{MODEL_PAGE_DPI}.json", sha256,
+        lambda: pdf_to_base64_images(pdf_path, dpi=MODEL_PAGE_DPI),
+    )
+
+
+def text_pages(pdf_path, sha256):
+    """Text layer of each page ([] when disabled or there is none), read once per catalogued content"""
+    if not local_extraction_enabled():
+        return []
+    return _cached_if_catalogued(f"{sha256}-text.json", sha256, lambda: pdf_text_pages(pdf_path))
+
+
+def _extraction_key(sha256, schema_id):
+    return f"{sha256}-extraction-{schema_id}.json"
+
+
+def cached_extraction(sha256, schema_id):
+    """{"pages": n, "fields": {...}} pre-extracted for this content and schema, or None"""
+    return page_images.get_json(_extraction_key(sha256, schema_id))
+
+
+def default_schema():
+    """The CompiledSchema from PREPROCESS_SCHEMA_FILE, or None"""
+    path = os.getenv("PREPROCESS_SCHEMA_FILE")
+    if not path:
+        return None
+    with _lock:
+        if path not in _default_schema:
+            with open(path, encoding="utf-8") as f:
+                _default_schema[path] = schema_registry.compile_schema(json.load(f))
+        return _default_schema[path]
+
+
+def preprocess_document(document):
+    """Warm the caches for one catalogued document (blocking)"""
+    from qwenmodel_sequential_enhanced import inference_sequential
+
+    sha256, pdf_path = document["sha256"], document["file_path"]
+    images = model_page_images(pdf_path, sha256)
+    texts = text_pages(pdf_path, sha256)
+
+    schema = default_schema()
+    if schema is None or not images or cached_extraction(sha256, schema.schema_id) is not None:
+        return
+    extracted = inference_sequential(images, schema, page_texts=texts)
+    page_images.put_json(_extraction_key(sha256, schema.schema_id), {"pages": len(images), "fields": extracted})
+    with catalog.transaction():
+        catalog.index_extraction([doc["doc_id"] for doc in catalog.find_by_hash(sha256)], extracted)
+
+
+def enqueue(doc_id):
+    """Queue a document for pre-processing; False when disabled or the queue is full"""
+    if not enabled() or _queue is None:
+        return False
+    try:
+        _queue.put_nowait(doc_id)
+    except asyncio.QueueFull:
+        metrics.incr("preprocess_dropped_total")
+        logger.warning(f"Pre-processing queue full; not pre-processing {doc_id}")
+        return False
+    with _lock:
+        _status["queued"] += 1
+    return True
+
+
+async def _worker():
+    # Model calls of this task yield to interactive and batch requests
+    scheduler.set_priority("background")
+    while True:
+        doc_id = await _queue.get()
+        with _lock:
+            _status["queued"] -= 1
+            _status["running"] += 1
+        started = time.perf_counter()
+        try:
+            document = catalog.get_document(doc_id)
+            if document is not None and document["sha256"]:
+                await asyncio.to_thread(preprocess_document, document)
+                metrics.incr("preprocess_jobs_total", result="ok")
+                metrics.observe("preprocess_seconds", time.perf_counter() - started)
+        except Exception as e:
+            metrics.incr("preprocess_jobs_total", result="error")
+            logger.warning(f"Pre-processing of {doc_id} failed: {e}")
+        finally:
+            with _lock:
+                _status["running"] -= 1
+            _queue.task_done()
+
+
+def start():
+    """Create the queue and its workers on the running event loop; returns the worker tasks"""
+    global _queue
+    if not enabled():
+        return []
+    _queue = asyncio.Queue(maxsize=int(os.getenv("PREPROCESS_QUEUE_SIZE", "100")))
+    concurrency = int(os.getenv("PREPROCESS_CONCURRENCY", "1"))
+    return [asyncio.create_task(_worker()) for _ in range(concurrency)]
+
+
+def status():
+    with _lock:
+        return {"enabled": enabled(), **_status}
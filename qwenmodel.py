@@ -1,36 +1,42 @@
 from io import BytesIO
 import json
-from openai import OpenAI
 import base64
-from pdf2image import convert_from_path
 import os
-from config import FORM_SYSTEM_PROMPT, logger
+from config import FORM_SYSTEM_PROMPT, SPARSE_OUTPUT_INSTRUCTION, SPARSE_ALIAS_INSTRUCTION, logger
+import metrics
+from schema_registry import compile_schema, resolve_aliases, expand_to_schema
+from structured_output import response_format_for, sparse_output_mode
+from llm_backend import get_backend
 from dotenv import load_dotenv
 
-# Configure OpenAI client with error handling
 load_dotenv()
 
-try:
-    client = OpenAI(
-        base_url=os.getenv("OPENAI_BASE_URL"),
-        api_key=os.getenv("OPENAI_API_KEY"),  # required, but unused
-    )
-    print(os.getenv("OPENAI_MODEL"))
-except Exception as e:
-    logger.error(f"Failed to initialize OpenAI client: {str(e)}")
-    raise
-
 def inference(image_base_64, HTML_CONTENT):
     try:
-        # Handle list of images like in summary.py
-        image_data = []
+        compiled_schema = compile_schema(HTML_CONTENT)
+        sparse_mode = sparse_output_mode()
+        use_aliases = sparse_mode == "aliases"
+        if use_aliases:
+            schema_fragment = compiled_schema.alias_prompt_fragment
+        else:
+            schema_fragment = compiled_schema.prompt_fragment
+
+        # Schema text first so requests for the same form share a cacheable
+        # prompt prefix; the page images vary per document and go last
+        image_data = [{"type": "text", "text": f"current form schema: {schema_fragment}"}]
+        if sparse_mode != "off":
+            image_data.append({"type": "text", "text": SPARSE_OUTPUT_INSTRUCTION})
+        if use_aliases:
+            image_data.append({"type": "text", "text": SPARSE_ALIAS_INSTRUCTION})
         for image in image_base_64:
             image_data.append({"type": "image_url", "image_url": {"url": image}})
         
-        # Add the HTML content as text
-        image_data.append({"type": "text", "text": f"current form schema: {HTML_CONTENT}"})
-        
-        response = client.chat.completions.create(
+        response = get_backend().chat(
+            response_format=response_format_for(
+                compiled_schema,
+                required=[] if sparse_mode != "off" else None,
+                use_aliases=use_aliases
+            ),
             model=os.getenv("OPENAI_MODEL"),
             temperature=0.1,
             messages=[
@@ -42,6 +48,7 @@ def inference(image_base_64, HTML_CONTENT):
             ],
         )
         
+        metrics.record_usage(response, "extraction", sparse=sparse_mode)
         print("response", response)
         # Check if response and choices exist
         if not response or not response.choices or len(response.choices) == 0:
@@ -64,10 +71,12 @@ def inference(image_base_64, HTML_CONTENT):
             content = raw_content[3:-3].strip()   # Remove ``` and ```
         
         logger.info("Successfully received inference response")
+        metrics.incr("llm_json_responses_total", operation="extraction")
         
         try:
-            return json.loads(content)
+            parsed = json.loads(content)
         except json.JSONDecodeError:
+            metrics.incr("llm_json_cleanups_total", operation="extraction")
             # If JSON parsing fails, try to clean the content more aggressively
             logger.warning("Initial JSON parsing failed, attempting cleanup")
             
@@ -80,12 +89,19 @@ def inference(image_base_64, HTML_CONTENT):
             
             if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
                 json_content = cleaned_content[start_idx:end_idx+1]
-                return json.loads(json_content)
+                parsed = json.loads(json_content)
             else:
+                metrics.incr("llm_json_parse_failures_total", operation="extraction")
                 logger.error(f"Could not extract valid JSON from content: {cleaned_content}")
                 raise ValueError("Invalid JSON response from AI model")
+
+        if use_aliases:
+            parsed = resolve_aliases(compiled_schema, parsed)
+        # Sparse output leaves fields out; restore the full schema with defaults
+        return expand_to_schema(compiled_schema, parsed)
                 
     except json.JSONDecodeError as e:
+        metrics.incr("llm_json_parse_failures_total", operation="extraction")
         logger.error(f"Failed to parse inference response as JSON: {str(e)}")
         logger.error(f"Raw content was: {raw_content if 'raw_content' in locals() else 'Not available'}")
         raise
@@ -94,6 +110,8 @@ def inference(image_base_64, HTML_CONTENT):
         raise
 
 def pdf_to_base64_images(pdf_path, dpi=300, image_format="png"):
+    from pdf2image import convert_from_path  # pulls in PIL; only needed when rendering
+
     try:
         logger.info(f"Converting PDF to images: {pdf_path}")
         images = convert_from_path(pdf_path, dpi=dpi)
@@ -1,36 +1,94 @@
 from io import BytesIO
 import json
-from openai import OpenAI
+import time
 import base64
-from pdf2image import convert_from_path
 import os
-from config import SEQUENTIAL_SYSTEM_PROMPT, logger
+from config import (
+    SEQUENTIAL_SYSTEM_PROMPT,
+    PAGE_SUMMARY_INSTRUCTION,
+    SPARSE_OUTPUT_INSTRUCTION,
+    SPARSE_ALIAS_INSTRUCTION,
+    logger,
+)
+import metrics
+from schema_registry import compile_schema, apply_validators, resolve_aliases, expand_to_schema
+from structured_output import response_format_for, sparse_output_mode
+from llm_backend import get_backend, sticky_routing
+from local_extractors import extract_fields, confident_fields
+from pincode_index import location_fields, fill_location
+
+SEQUENTIAL_CONTEXT_MODES = ("text", "conversation")
+
+# Keys the sequential prompt asks for on top of the form schema
+SENDER_CONFIDENCE_PROPERTIES = {
+    "senderConfidence": {"type": ["number", "null"]},
+    "senderConfidenceReason": {"type": ["string", "null"]},
+}
 from dotenv import load_dotenv
 
-# Configure OpenAI client
 load_dotenv()
 
-try:
-    client = OpenAI(
-        base_url=os.getenv("OPENAI_BASE_URL"),
-        api_key=os.getenv("OPENAI_API_KEY"),
-    )
-    print(f"Enhanced Sequential Model: {os.getenv('OPENAI_MODEL')}")
-except Exception as e:
-    logger.error(f"Failed to initialize OpenAI client: {str(e)}")
-    raise
-
-def inference_sequential(image_list, form_schema):
+def inference_sequential(image_list, form_schema, page_summaries=None, page_texts=None):
     """
     Enhanced sequential processing with comprehensive context:
     - Summary of all previous pages
     - Previous page's detailed JSON
     - Cumulative confidence tracking
+
+    When page_summaries is a list, each page call also returns a short page
+    summary (appended in page order, "" on failure), so a document summary can
+    be built without sending the pages through the model a second time.
+
+    form_schema may be a raw schema dict or a registered CompiledSchema.
+
+    page_texts (the PDF text layer per page) feeds the rule-based extractors:
+    regular fields they find with high confidence are not requested from the
+    model at all, weaker hits fill whatever the model leaves empty.
+
+    SEQUENTIAL_CONTEXT_MODE selects how earlier pages reach the model:
+    "text" rebuilds a text context from their summaries and JSON for every
+    page; "conversation" appends each page as a new user turn after the
+    earlier pages and answers, so backends with prefix caching only prefill
+    the new page. "auto" (default) uses conversation on backends that declare
+    prefix_caching (vllm, ollama) and text otherwise. A conversation restarts
+    with a text context after SEQUENTIAL_CONVERSATION_MAX_PAGES pages to
+    bound its length.
     """
+    # With a backend pool, all pages of the document go to the same server
+    # so each page reuses the KV cache of the shared prompt prefix
+    with sticky_routing():
+        return _inference_sequential(image_list, form_schema, page_summaries, page_texts)
+
+def _inference_sequential(image_list, form_schema, page_summaries, page_texts):
     if not image_list:
         return {}
 
-    logger.info(f"Enhanced sequential processing of {len(image_list)} images")
+    compiled_schema = compile_schema(form_schema)
+
+    rule_fields = extract_fields(page_texts or [], compiled_schema.expected_fields)
+    if "pincode" in confident_fields(rule_fields):
+        # A known PIN code settles state, city and country without the model
+        for field, value in location_fields(rule_fields["pincode"][0], compiled_schema).items():
+            rule_fields.setdefault(field, value)
+    skipped_fields = confident_fields(rule_fields)
+    if skipped_fields:
+        model_schema = compile_schema({
+            field: info for field, info in compiled_schema.schema.items() if field not in skipped_fields
+        }, register=False)
+        logger.info(f"Rule-based extraction filled {sorted(skipped_fields)}; not requesting them from the model")
+    else:
+        model_schema = compiled_schema
+
+    context_mode = os.getenv("SEQUENTIAL_CONTEXT_MODE", "auto")
+    if context_mode == "auto":
+        context_mode = "conversation" if get_backend().capabilities["prefix_caching"] else "text"
+    if context_mode not in SEQUENTIAL_CONTEXT_MODES:
+        raise ValueError(f"Unknown SEQUENTIAL_CONTEXT_MODE: {context_mode}")
+    max_conversation_pages = int(os.getenv("SEQUENTIAL_CONVERSATION_MAX_PAGES", "6"))
+    # Earlier user/assistant turns of the current conversation (conversation mode)
+    history = [] if context_mode == "conversation" else None
+
+    logger.info(f"Enhanced sequential processing of {len(image_list)} images ({context_mode} context)")
 
     combined_data = {}
     previous_page_data = {}
@@ -41,15 +99,32 @@ def inference_sequential(image_list, form_schema):
         page_num = i + 1
         logger.info(f"Processing page {page_num}/{len(image_list)}")
 
-        # Build enhanced context message
-        context_msg = _build_enhanced_context(
-            page_num, len(image_list), previous_page_data, 
-            all_pages_summary, confidence_history
-        )
+        if history is not None and len(history) >= 2 * max_conversation_pages:
+            # Start over with a text context rather than growing the conversation further
+            history = []
+
+        if history:
+            context_msg = _build_turn_context(page_num, len(image_list))
+        else:
+            # Build enhanced context message
+            context_msg = _build_enhanced_context(
+                page_num, len(image_list), previous_page_data, 
+                all_pages_summary, confidence_history
+            )
 
         try:
             # Process single page with enhanced context
-            page_result = _process_page_enhanced(image, form_schema, context_msg, page_num)
+            page_result = _process_page_enhanced(
+                image, model_schema, context_msg, page_num,
+                with_summary=page_summaries is not None,
+                known_data=combined_data,
+                is_last_page=page_num == len(image_list),
+                history=history
+            )
+
+            if page_summaries is not None:
+                page_summary_text = page_result.pop("pageSummary", None) if page_result else None
+                page_summaries.append(str(page_summary_text).strip() if page_summary_text else "")
 
             if page_result:
                 # Track confidence for this page
@@ -75,6 +150,8 @@ def inference_sequential(image_list, form_schema):
 
         except Exception as e:
             logger.error(f"[ERROR] Page {page_num} failed: {e}")
+            if page_summaries is not None and len(page_summaries) < page_num:
+                page_summaries.append("")
             # Add error info to summaries for context
             all_pages_summary.append({
                 "page": page_num,
@@ -83,8 +160,14 @@ def inference_sequential(image_list, form_schema):
             })
             continue
 
+    # Rule-based hits, whatever the pages returned: the confident ones were
+    # not requested from the model, so an empty or failed page cannot lose them
+    combined_data = _merge_rule_fields(combined_data, rule_fields)
+
     # Final validation and cleanup
-    final_data = _validate_and_finalize_data(combined_data, confidence_history)
+    final_data = _validate_and_finalize_data(combined_data, confidence_history, compiled_schema)
+    final_data = fill_location(final_data, compiled_schema)
+    final_data = apply_validators(compiled_schema, final_data)
     
     logger.info(f"Enhanced sequential processing completed. Final confidence: {final_data.get('senderConfidence', 'N/A')}")
     return final_data
@@ -135,25 +218,112 @@ def _build_enhanced_context(page_num, total_pages, previous_page_data, all_pages
     
     return "\n".join(context_parts)
 
-def _process_page_enhanced(image, form_schema, context, page_num):
-    """Process single page with enhanced context and error handling"""
+def _build_turn_context(page_num, total_pages):
+    """Context for a continuation turn: earlier pages and answers are already in the conversation"""
+    return (f"Page {page_num} of {total_pages}. The earlier pages and your JSON for them are above in this "
+            f"conversation. Extract information for the form schema from this page, following the same rules.")
+
+def _process_page_enhanced(image, compiled_schema, context, page_num, with_summary=False,
+                           known_data=None, is_last_page=False, history=None):
+    """
+    Process single page with enhanced context and error handling.
+
+    With OPENAI_MODEL_SMALL set, the page goes to the small model first and is
+    escalated to OPENAI_MODEL only when the small model's answer is invalid
+    JSON, has a weak sender confidence or misses too many required fields.
+
+    history is the conversation so far in conversation mode (None in text
+    mode); the page's user turn and the model's answer are appended to it
+    when the page succeeds.
+    """
+    sparse_mode = sparse_output_mode()
+    use_aliases = sparse_mode == "aliases"
+    if use_aliases:
+        schema_fragment = compiled_schema.alias_prompt_fragment
+    else:
+        schema_fragment = compiled_schema.prompt_fragment
+
+    # Static parts first (system prompt, canonical schema, instructions) so
+    # consecutive requests share a cacheable prefix; per-page parts last.
+    # Continuation turns find the static parts earlier in the conversation.
+    user_content = []
+    if not history:
+        user_content.append({"type": "text", "text": f"FORM SCHEMA TO POPULATE:\n{schema_fragment}"})
+        if sparse_mode != "off":
+            user_content.append({"type": "text", "text": SPARSE_OUTPUT_INSTRUCTION})
+        if use_aliases:
+            user_content.append({"type": "text", "text": SPARSE_ALIAS_INSTRUCTION})
+        if with_summary:
+            user_content.append({"type": "text", "text": PAGE_SUMMARY_INSTRUCTION})
+    user_content.append({"type": "text", "text": f"CONTEXT:\n{context}"})
+    user_content.append({"type": "image_url", "image_url": {"url": image}})
+
+    extra_properties = dict(SENDER_CONFIDENCE_PROPERTIES)
+    if with_summary:
+        extra_properties["pageSummary"] = {"type": "string"}
+
+    request = {
+        "response_format": response_format_for(
+            compiled_schema, extra_properties,
+            required=[] if sparse_mode != "off" else None,
+            use_aliases=use_aliases
+        ),
+        "messages": [
+            {"role": "system", "content": SEQUENTIAL_SYSTEM_PROMPT},
+            *(history or []),
+            {
+                "role": "user",
+                "content": user_content,
+            },
+        ],
+        "sparse_mode": sparse_mode,
+        "use_aliases": use_aliases,
+        "context_mode": "text" if history is None else "conversation",
+    }
+
+    large_model = os.getenv("OPENAI_MODEL")
+    small_model = os.getenv("OPENAI_MODEL_SMALL")
+    if small_model and small_model != large_model:
+        metrics.incr("cascade_small_pages_total")
+        try:
+            parsed_data, raw_content = _request_page(small_model, "small", request, compiled_schema, context, page_num)
+            reason = _escalation_reason(parsed_data, compiled_schema, known_data, is_last_page)
+        except Exception as e:
+            logger.warning(f"Small model failed on page {page_num}: {e}")
+            reason = "invalid_json" if isinstance(e, json.JSONDecodeError) else "error"
+
+        if reason is None:
+            _append_turn(history, request, raw_content)
+            return parsed_data
+        metrics.incr("cascade_escalations_total")
+        metrics.incr("cascade_escalation_reasons_total", reason=reason)
+        logger.info(f"Escalating page {page_num} to {large_model}: {reason}")
+
+    parsed_data, raw_content = _request_page(large_model, "large", request, compiled_schema, context, page_num)
+    _append_turn(history, request, raw_content)
+    return parsed_data
+
+def _append_turn(history, request, raw_content):
+    """Keep the page's user turn and the model's answer for the next page (conversation mode)"""
+    if history is not None:
+        history.append(request["messages"][-1])
+        history.append({"role": "assistant", "content": raw_content})
+
+def _request_page(model, tier, request, compiled_schema, context, page_num):
+    """Run one page request against a model; returns the parsed JSON answer and the raw text"""
+    raw_content = None
     try:
-        response = client.chat.completions.create(
-            model=os.getenv("OPENAI_MODEL"),
+        started = time.perf_counter()
+        response = get_backend().chat(
+            response_format=request["response_format"],
+            hedge=True,
+            model=model,
             temperature=0.1,
             max_tokens=4000,  # Increased for complex responses
-            messages=[
-                {"role": "system", "content": SEQUENTIAL_SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "image_url", "image_url": {"url": image}},
-                        {"type": "text", "text": f"FORM SCHEMA TO POPULATE:\n{form_schema}"},
-                        {"type": "text", "text": f"CONTEXT:\n{context}"}
-                    ],
-                },
-            ],
+            messages=request["messages"],
         )
+        metrics.observe("llm_request_seconds", time.perf_counter() - started, operation="extraction", tier=tier)
+        metrics.record_usage(response, "extraction", sparse=request["sparse_mode"], context=request["context_mode"])
         # print("Form schema: ", form_schema)
         print("Context: ", context)
         print("Response: ", response)
@@ -162,9 +332,17 @@ def _process_page_enhanced(image, form_schema, context, page_num):
         # print("Raw content: ", raw_content)
         logger.debug(f"Page {page_num} raw response: {raw_content[:200]}...")
         
-        # Enhanced JSON cleaning
-        content = _clean_json_response(raw_content)
-        parsed_data = json.loads(content)
+        metrics.incr("llm_json_responses_total", operation="extraction")
+        try:
+            parsed_data = json.loads(raw_content)
+        except json.JSONDecodeError:
+            # Backends without structured output may wrap the JSON in prose or code fences
+            metrics.incr("llm_json_cleanups_total", operation="extraction")
+            content = _clean_json_response(raw_content)
+            parsed_data = json.loads(content)
+
+        if request["use_aliases"]:
+            parsed_data = resolve_aliases(compiled_schema, parsed_data)
         
         # Validate required confidence fields for sender data
         if any(key in parsed_data for key in ['name', 'designation', 'organisation']):
@@ -172,9 +350,10 @@ def _process_page_enhanced(image, form_schema, context, page_num):
                 parsed_data['senderConfidence'] = 0.5  # Default medium confidence
                 parsed_data['senderConfidenceReason'] = "Confidence not specified by model"
         
-        return parsed_data
+        return parsed_data, raw_content
         
     except json.JSONDecodeError as e:
+        metrics.incr("llm_json_parse_failures_total", operation="extraction")
         logger.error(f"JSON parsing error on page {page_num}: {e}")
         logger.error(f"Raw content: {raw_content}")
         raise
@@ -182,6 +361,38 @@ def _process_page_enhanced(image, form_schema, context, page_num):
         logger.error(f"Processing error on page {page_num}: {e}")
         raise
 
+def _escalation_reason(page_data, compiled_schema, known_data, is_last_page):
+    """Why a small-model answer is not good enough, or None to accept it"""
+    if not isinstance(page_data, dict):
+        return "invalid_json"
+
+    min_confidence = float(os.getenv("CASCADE_MIN_SENDER_CONFIDENCE", "0.7"))
+    has_sender = any(page_data.get(key) for key in ['name', 'designation', 'organisation'])
+    if has_sender:
+        try:
+            confidence = float(page_data.get("senderConfidence") or 0.0)
+        except (TypeError, ValueError):
+            confidence = 0.0
+        if confidence < min_confidence:
+            return "sender_confidence"
+    elif is_last_page and "name" in compiled_schema.expected_fields and not (known_data or {}).get("name"):
+        # The signature block is normally on the last page
+        return "sender_missing"
+
+    required = [
+        field for field, info in compiled_schema.compact.items()
+        if isinstance(info, dict) and info.get("required")
+    ]
+    if required:
+        known = known_data or {}
+        covered = sum(1 for field in required if page_data.get(field) is not None or known.get(field) is not None)
+        min_coverage = float(os.getenv("CASCADE_MIN_REQUIRED_COVERAGE", "0.8"))
+        # Earlier pages may still fill fields, so coverage is only judged at the end
+        if is_last_page and covered / len(required) < min_coverage:
+            return "required_coverage"
+
+    return None
+
 def _clean_json_response(raw_content):
     """Enhanced JSON cleaning with better error handling"""
     content = raw_content.strip()
@@ -300,6 +511,15 @@ def _intelligent_merge_with_history(combined_data, page_result, confidence_histo
     
     return merged_data
 
+def _merge_rule_fields(data, rule_fields):
+    """Rule-based hits: confident ones win, weaker ones only fill gaps"""
+    merged_data = dict(data)
+    confident = confident_fields(rule_fields)
+    for field, (value, confidence) in rule_fields.items():
+        if field in confident or merged_data.get(field) is None:
+            merged_data[field] = value
+    return merged_data
+
 def _merge_partial_sender_improvements(new_data, existing_data, new_confidence, existing_confidence):
     """Merge sender fields intelligently, allowing partial improvements"""
     
@@ -329,8 +549,12 @@ def _merge_partial_sender_improvements(new_data, existing_data, new_confidence,
     
     return new_data
 
-def _validate_and_finalize_data(data, confidence_history):
+def _validate_and_finalize_data(data, confidence_history, compiled_schema=None):
     """Final validation and cleanup of extracted data"""
+
+    # Sparse output leaves fields out; restore the full schema with defaults
+    if compiled_schema is not None:
+        data = expand_to_schema(compiled_schema, data)
     
     # Ensure all required confidence fields are present
     if any(key in data for key in ['name', 'designation', 'organisation']):
@@ -352,6 +576,8 @@ def _validate_and_finalize_data(data, confidence_history):
 
 def pdf_to_base64_images(pdf_path, dpi=150):
     """Convert PDF to images with enhanced error handling"""
+    from pdf2image import convert_from_path  # pulls in PIL; only needed when rendering
+
     try:
         images = convert_from_path(pdf_path, dpi=dpi)
         base64_images = []
@@ -399,3 +625,30 @@ def process_pdf_sequential_enhanced(pdf_path, form_schema):
         logger.error(f"Error in enhanced sequential processing: {str(e)}")
         raise
 
+
+if __name__ == "__main__":
+    # Compare prefilled tokens per page across context modes:
+    # python qwenmodel_sequential_enhanced.py letter.pdf schema.json [mode ...]
+    import sys
+
+    if len(sys.argv) < 3:
+        print("Usage: python qwenmodel_sequential_enhanced.py <pdf_path> <schema.json> [mode ...]")
+        sys.exit(1)
+
+    images = pdf_to_base64_images(sys.argv[1])
+    with open(sys.argv[2], encoding="utf-8") as f:
+        schema = json.load(f)
+
+    for mode in sys.argv[3:] or SEQUENTIAL_CONTEXT_MODES:
+        os.environ["SEQUENTIAL_CONTEXT_MODE"] = mode
+        inference_sequential(images, schema)
+
+    counters = metrics.snapshot()["counters"]
+    for mode in sys.argv[3:] or SEQUENTIAL_CONTEXT_MODES:
+        suffix = f"{{context={mode},operation=extraction,sparse={sparse_output_mode()}}}"
+        requests_made = counters.get("llm_requests_total" + suffix, 0)
+        prefilled = counters.get("llm_prefill_tokens_total" + suffix, 0)
+        prompt = counters.get("llm_prompt_tokens_total" + suffix, 0)
+        if requests_made:
+            print(f"{mode:>12}: {prefilled / requests_made:8.0f} prefilled / {prompt / requests_made:8.0f} prompt "
+                  f"tokens per page over {requests_made:.0f} page calls")
@@ -0,0 +1,182 @@
+"""
+Priority scheduling of model calls.
+
+Every model call (Backend.chat / BackendPool.chat) takes one of
+LLM_CONCURRENCY slots (default 4 per configured server, 0 = unlimited)
+for its duration. When all slots are busy, waiting calls are admitted by
+weighted fair queuing over three priority classes:
+
+- interactive: a user is waiting (the default for API requests)
+- batch: bulk processing submitted through the API
+- background: upload-time pre-processing
+
+LLM_PRIORITY_WEIGHTS (default interactive=8,batch=2,background=1) sets each
+class's share of the slots while they are contended, so a backlog of
+background work cannot starve interactive requests, yet still progresses.
+Aging moves a waiting call ahead by one background-sized turn every
+LLM_PRIORITY_AGING_SECONDS (default 30) so no single call waits forever.
+
+The class is taken from a context variable: set_priority() in the request
+handler (or worker task) applies to every model call made from it,
+including those in asyncio.to_thread. Queue waits are recorded per class
+as llm_queue_wait_seconds{priority=...}; each slot is held per worker.
+"""
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+PRIORITIES = ("interactive", "batch", "background")
+DEFAULT_WEIGHTS = {"interactive": 8.0, "batch": 2.0, "background": 1.0}
+
+_priority = contextvars.ContextVar("llm_priority", default="interactive")
+_lock = threading.Lock()
+_scheduler = None
+_scheduler_config = None
+
+
+def set_priority(priority):
+    """Set the priority class for model calls made from the current context; None keeps the default"""
+    if priority is None:
+        return
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority {priority!r}; use one of {', '.join(PRIORITIES)}")
+    _priority.set(priority)
+
+
+def current_priority():
+    return _priority.get()
+
+
+def _weights():
+    weights = dict(DEFAULT_WEIGHTS)
+    for item in os.getenv("LLM_PRIORITY_WEIGHTS", "").split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            if name.strip() in weights:
+                weights[name.strip()] = max(float(value), 0.001)
+    return weights
+
+
+class _Waiter:
+    __slots__ = ("priority", "tag", "enqueued", "granted")
+
+    def __init__(self, priority, tag, enqueued):
+        self.priority = priority
+        self.tag = tag
+        self.enqueued = enqueued
+        self.granted = False
+
+
+class Scheduler:
+    """A counting semaphore that admits waiters by weighted fair queuing with aging"""
+
+    def __init__(self, capacity, weights=None, aging_seconds=30.0):
+        self.capacity = capacity
+        self.weights = weights or dict(DEFAULT_WEIGHTS)
+        self.aging_seconds = aging_seconds
+        self.in_use = 0
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._virtual_time = 0.0
+        self._last_tag = {priority: 0.0 for priority in PRIORITIES}
+
+    def _tag(self, priority):
+        """Virtual finish time of a new call: one turn of 1/weight after the class's previous call"""
+        tag = max(self._virtual_time, self._last_tag[priority]) + 1.0 / self.weights[priority]
+        self._last_tag[priority] = tag
+        return tag
+
+    def _dispatch(self):
+        now = time.monotonic()
+        # Aging: every aging_seconds of waiting is worth one turn of the lowest weight
+        credit = max(1.0 / weight for weight in self.weights.values()) / self.aging_seconds
+        while self.in_use < self.capacity and self._waiting:
+            waiter = min(self._waiting, key=lambda w: w.tag - (now - w.enqueued) * credit)
+            self._waiting.remove(waiter)
+            waiter.granted = True
+            self.in_use += 1
+            self._virtual_time = max(self._virtual_time, waiter.tag)
+        self._cond.notify_all()
+
+    def acquire(self, priority):
+        """Block until a slot is granted; returns the seconds spent waiting"""
+        started = time.monotonic()
+        with self._cond:
+            tag = self._tag(priority)
+            if self.in_use < self.capacity and not self._waiting:
+                self.in_use += 1
+                self._virtual_time = max(self._virtual_time, tag)
+                return 0.0
+            waiter = _Waiter(priority, tag, started)
+            self._waiting.append(waiter)
+            try:
+                while not waiter.granted:
+                    self._cond.wait()
+            except BaseException:
+                if waiter.granted:
+                    self.in_use -= 1
+                else:
+                    self._waiting.remove(waiter)
+                self._dispatch()
+                raise
+        return time.monotonic() - started
+
+    def release(self):
+        with self._cond:
+            self.in_use -= 1
+            self._dispatch()
+
+    def status(self):
+        with self._cond:
+            waiting = {priority: 0 for priority in PRIORITIES}
+            for waiter in self._waiting:
+                waiting[waiter.priority] += 1
+            return {"capacity": self.capacity, "in_use": self.in_use, "waiting": waiting}
+
+
+def _default_capacity():
+    servers = [url for url in os.getenv("OPENAI_BASE_URLS", "").split(",") if url.strip()]
+    return 4 * max(len(servers), 1)
+
+
+def get_scheduler():
+    """The process-wide scheduler, or None when LLM_CONCURRENCY=0"""
+    global _scheduler, _scheduler_config
+    config = (
+        os.getenv("LLM_CONCURRENCY"), os.getenv("LLM_PRIORITY_WEIGHTS"),
+        os.getenv("LLM_PRIORITY_AGING_SECONDS"), os.getenv("OPENAI_BASE_URLS"),
+    )
+    with _lock:
+        if _scheduler_config != config:
+            capacity = int(os.getenv("LLM_CONCURRENCY") or _default_capacity())
+            _scheduler = Scheduler(
+                capacity, _weights(), float(os.getenv("LLM_PRIORITY_AGING_SECONDS", "30"))
+            ) if capacity > 0 else None
+            _scheduler_config = config
+        return _scheduler
+
+
+@contextmanager
+def model_slot():
+    """Hold a model call slot at the current priority for the duration of the block"""
+    scheduler = get_scheduler()
+    if scheduler is None:
+        yield
+        return
+    priority = _priority.get()
+    waited = scheduler.acquire(priority)
+    metrics.observe("llm_queue_wait_seconds", waited, priority=priority)
+    metrics.incr("llm_scheduled_calls_total", priority=priority)
+    try:
+        yield
+    finally:
+        scheduler.release()
+
+
+def status():
+    scheduler = get_scheduler()
+    return scheduler.status() if scheduler is not None else {"capacity": None}
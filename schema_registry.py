@@ -0,0 +1,244 @@
+"""
+Server-side registry of form schemas.
+
+The extension scans the same form on every request. Registering the schema
+once returns a schema_id (a hash of the canonical schema) and caches
+everything derived from it: the compact prompt fragment sent to the model,
+the list of expected fields and per-field validators. Extraction requests can
+then send the schema_id instead of the full schema.
+
+register_schema() stores the canonical schema in the shared catalog, so the
+schema_id resolves on every worker and after restarts. Compiled schemas are
+cached per worker in a bounded LRU (SCHEMA_REGISTRY_SIZE, default 256) in
+front of it.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import catalog
+from config import canonical_schema, logger
+
+# Option-bearing field types where the model must pick one of the options
+CLOSED_OPTION_TYPES = ("select", "select-one", "radio")
+
+
+class CompiledSchema:
+    """A form schema plus the prompt fragments and validators derived from it"""
+
+    def __init__(self, schema_id, schema, compact, expected_fields, validators):
+        self.schema_id = schema_id
+        self.schema = schema
+        self.compact = compact
+        self.prompt_fragment = canonical_schema(compact)
+        self.expected_fields = expected_fields
+        self.validators = validators
+
+        # Short output keys for sparse output ("f1", "f2", ...), stable per schema
+        self.aliases = {f"f{i}": name for i, name in enumerate(expected_fields, start=1)}
+        self.field_aliases = {name: alias for alias, name in self.aliases.items()}
+        self.alias_prompt_fragment = canonical_schema({
+            alias: {"field": name, **compact[name]} if isinstance(compact[name], dict) else {"field": name}
+            for alias, name in self.aliases.items()
+        })
+
+
+_lock = threading.Lock()
+_registry = OrderedDict()
+
+
+def schema_id_for(form_schema):
+    """Content hash of the canonical schema serialization"""
+    return hashlib.sha256(canonical_schema(form_schema).encode("utf-8")).hexdigest()[:32]
+
+
+def _compact_option(option):
+    if not isinstance(option, dict):
+        return option
+    value = option.get("value")
+    text = option.get("text")
+    if value in (None, ""):
+        # Placeholder entries such as "Select..." carry no selectable value
+        return None
+    if not text or str(text).strip() == str(value).strip():
+        return value
+    return {"value": value, "text": text}
+
+
+def _compact_field(field_name, field_info):
+    """Keep only what the model needs: type, required, label, options, currentValue, min/max"""
+    if not isinstance(field_info, dict):
+        return field_info
+
+    compact = {"type": field_info.get("type", "text")}
+    if field_info.get("required"):
+        compact["required"] = True
+    label = field_info.get("label")
+    if label and str(label).strip() != field_name:
+        compact["label"] = str(label).strip()
+    options = [_compact_option(option) for option in field_info.get("options") or []]
+    options = [option for option in options if option not in (None, "")]
+    if options:
+        compact["options"] = options
+    for key in ("currentValue", "min", "max"):
+        if field_info.get(key) not in (None, ""):
+            compact[key] = field_info[key]
+    return compact
+
+
+def _option_validator(field_info, closed):
+    """Map the model's answer onto an option value (matching value or text, case-insensitively)"""
+    lookup = {}
+    for option in field_info.get("options") or []:
+        if isinstance(option, dict):
+            value = option.get("value")
+            if value in (None, ""):
+                continue
+            lookup[str(value).strip().lower()] = value
+            if option.get("text"):
+                lookup.setdefault(str(option["text"]).strip().lower(), value)
+        elif option not in (None, ""):
+            lookup[str(option).strip().lower()] = option
+
+    def validate(value):
+        if value is None:
+            return None
+        matched = lookup.get(str(value).strip().lower())
+        if matched is not None:
+            return matched
+        return None if closed else value
+
+    return validate
+
+
+def _checkbox_validator(value):
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in ("true", "yes", "1"):
+            return True
+        if lowered in ("false", "no", "0"):
+            return False
+        return None
+    return value
+
+
+def _number_validator(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        number = float(str(value).replace(",", "").strip())
+    except ValueError:
+        return None
+    return int(number) if number.is_integer() else number
+
+
+def _build_validators(form_schema):
+    validators = {}
+    for field_name, field_info in form_schema.items():
+        if not isinstance(field_info, dict):
+            continue
+        field_type = field_info.get("type")
+        if field_type == "checkbox":
+            # Checkbox groups carry options and may hold several values; leave them as returned
+            if not field_info.get("options"):
+                validators[field_name] = _checkbox_validator
+        elif field_info.get("options"):
+            validators[field_name] = _option_validator(field_info, field_type in CLOSED_OPTION_TYPES)
+        elif field_type in ("number", "range"):
+            validators[field_name] = _number_validator
+    return validators
+
+
+def compile_schema(form_schema, register=True):
+    """
+    Return the cached CompiledSchema for a form schema, compiling and
+    registering it on first use. Already compiled schemas pass through.
+    With register=False a schema that is not registered yet is compiled
+    without entering the registry (e.g. per-request subsets), so it cannot
+    evict the schemas clients refer to by schemaId.
+    """
+    if isinstance(form_schema, CompiledSchema):
+        return form_schema
+
+    schema_id = schema_id_for(form_schema)
+    with _lock:
+        compiled = _registry.get(schema_id)
+        if compiled is not None:
+            _registry.move_to_end(schema_id)
+            return compiled
+
+    compiled = CompiledSchema(
+        schema_id=schema_id,
+        schema=form_schema,
+        compact={name: _compact_field(name, info) for name, info in form_schema.items()},
+        expected_fields=sorted(form_schema.keys()),
+        validators=_build_validators(form_schema),
+    )
+    if not register:
+        return compiled
+
+    max_entries = int(os.getenv("SCHEMA_REGISTRY_SIZE", "256"))
+    with _lock:
+        _registry[schema_id] = compiled
+        while len(_registry) > max_entries:
+            _registry.popitem(last=False)
+
+    logger.info(f"Registered form schema {schema_id} ({len(compiled.expected_fields)} fields, "
+                f"prompt fragment {len(compiled.prompt_fragment)} characters)")
+    return compiled
+
+
+def register_schema(form_schema):
+    """Compile a form schema and store it in the catalog so every worker can resolve its schema_id"""
+    compiled = compile_schema(form_schema)
+    catalog.add_form_schema(compiled.schema_id, canonical_schema(compiled.schema))
+    return compiled
+
+
+def get_schema(schema_id):
+    """
+    Return the CompiledSchema for schema_id: cached in this worker, else
+    compiled from the catalog record; None if it was never registered.
+    """
+    with _lock:
+        compiled = _registry.get(schema_id)
+        if compiled is not None:
+            _registry.move_to_end(schema_id)
+            return compiled
+
+    stored = catalog.get_form_schema(schema_id)
+    if stored is None:
+        return None
+    return compile_schema(json.loads(stored))
+
+
+def resolve_aliases(compiled, data):
+    """Translate short output keys back to field names; other keys pass through"""
+    return {compiled.aliases.get(key, key): value for key, value in data.items()}
+
+
+def expand_to_schema(compiled, data):
+    """
+    Fill every schema field the model left out (sparse output) with the
+    field's currentValue default, or None.
+    """
+    expanded = dict(data)
+    for field_name in compiled.expected_fields:
+        if field_name not in expanded:
+            field_info = compiled.schema.get(field_name)
+            expanded[field_name] = field_info.get("currentValue") if isinstance(field_info, dict) else None
+    return expanded
+
+
+def apply_validators(compiled, data):
+    """Normalize extracted values with the schema's validators (select options, checkboxes, numbers)"""
+    validated = dict(data)
+    for field_name, validator in compiled.validators.items():
+        if field_name in validated:
+            try:
+                validated[field_name] = validator(validated[field_name])
+            except Exception as e:
+                logger.warning(f"Validator for {field_name} failed on {validated[field_name]!r}: {e}")
+    return validated
@@ -0,0 +1,89 @@
+"""
+Structured (constrained) JSON output for extraction calls.
+
+Builds an OpenAI-style response_format from a compiled form schema so the
+backend can constrain decoding to valid JSON with the expected keys.
+STRUCTURED_OUTPUT selects the mode: "json_schema" (default), "json_object"
+or "off". Backends that reject response_format are called without it (see
+llm_backend); the callers' JSON cleaners remain the fallback in that case.
+
+SPARSE_OUTPUT selects the output protocol: "off" (all fields, default),
+"on" (only fields with a value) or "aliases" (only fields with a value,
+keyed by the schema's short aliases). Omitted fields are filled server-side.
+"""
+import os
+
+STRUCTURED_OUTPUT_MODES = ("json_schema", "json_object", "off")
+SPARSE_OUTPUT_MODES = ("off", "on", "aliases")
+
+
+def _field_json_schema(field_info):
+    """JSON Schema for one form field's value; every field is nullable"""
+    if not isinstance(field_info, dict):
+        return {}
+
+    field_type = field_info.get("type")
+    options = field_info.get("options") or []
+
+    if field_type == "checkbox":
+        if options:
+            return {"type": ["array", "string", "null"], "items": {"type": "string"}}
+        return {"type": ["boolean", "null"]}
+
+    if options and field_type in ("select", "select-one", "radio"):
+        values = []
+        for option in options:
+            value = option.get("value") if isinstance(option, dict) else option
+            if value not in (None, "") and value not in values:
+                values.append(value)
+        if values:
+            return {"enum": values + [None]}
+
+    if field_type in ("number", "range"):
+        return {"type": ["number", "null"]}
+
+    return {"type": ["string", "null"]}
+
+
+def sparse_output_mode():
+    mode = os.getenv("SPARSE_OUTPUT", "off")
+    if mode not in SPARSE_OUTPUT_MODES:
+        raise ValueError(f"Unknown SPARSE_OUTPUT mode: {mode}")
+    return mode
+
+
+def json_schema_for(compiled_schema, extra_properties=None, required=None, use_aliases=False):
+    """
+    JSON Schema for a flat object holding the form fields (or their aliases)
+    plus any extra properties (e.g. senderConfidence). All keys are required
+    unless a narrower list is given.
+    """
+    properties = {
+        compiled_schema.field_aliases[field_name] if use_aliases else field_name: _field_json_schema(field_info)
+        for field_name, field_info in compiled_schema.schema.items()
+    }
+    properties.update(extra_properties or {})
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": sorted(properties) if required is None else list(required),
+        "additionalProperties": False,
+    }
+
+
+def response_format_for(compiled_schema, extra_properties=None, required=None, use_aliases=False):
+    """Return the response_format argument for the configured mode, or None when off"""
+    mode = os.getenv("STRUCTURED_OUTPUT", "json_schema")
+    if mode not in STRUCTURED_OUTPUT_MODES:
+        raise ValueError(f"Unknown STRUCTURED_OUTPUT mode: {mode}")
+    if mode == "off":
+        return None
+    if mode == "json_object":
+        return {"type": "json_object"}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": f"form_{compiled_schema.schema_id}",
+            "schema": json_schema_for(compiled_schema, extra_properties, required, use_aliases),
+        },
+    }
@@ -0,0 +1,97 @@
+"""
+Stub OpenAI-compatible model servers for trying the backend pool locally.
+
+    python stub_llm_server.py --ports 9001 9002 9003 --latency 0.5 --fail-ports 9002
+    python stub_llm_server.py --latency 0.2 --slow-fraction 0.05 --slow-latency 5
+
+then run the app with
+
+    OPENAI_BASE_URLS=http://localhost:9001/v1,http://localhost:9002/v1,http://localhost:9003/v1
+
+Each server answers /v1/models (health checks) and /v1/chat/completions
+with an empty JSON object after --latency seconds; --fail-ports answer
+everything with 503 so ejection and failover can be watched in /metrics.
+--slow-fraction of the completions take --slow-latency instead, to try
+hedged requests (LLM_HEDGE=on).
+The served model name includes the port, so responses show where a
+request was routed.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(port, latency, failing, slow_fraction=0.0, slow_latency=0.0):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if failing:
+                return self._send(503, {"error": "stub server failing"})
+            if self.path.rstrip("/").endswith("/models"):
+                return self._send(200, {"object": "list", "data": [{"id": f"stub-{port}", "object": "model"}]})
+            self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if failing:
+                return self._send(503, {"error": "stub server failing"})
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                return self._send(404, {"error": "not found"})
+
+            time.sleep(slow_latency if random.random() < slow_fraction else latency)
+            self._send(200, {
+                "id": f"stub-{port}-{time.time_ns()}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": f"stub-{port}:{request.get('model')}",
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "{}"},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 1, "total_tokens": 101},
+            })
+
+        def log_message(self, format, *args):
+            print(f"[{port}] {format % args}")
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ports", type=int, nargs="+", default=[9001, 9002, 9003])
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per chat completion")
+    parser.add_argument("--fail-ports", type=int, nargs="*", default=[], help="ports that answer 503")
+    parser.add_argument("--slow-fraction", type=float, default=0.0, help="share of completions that are slow")
+    parser.add_argument("--slow-latency", type=float, default=5.0, help="seconds per slow completion")
+    args = parser.parse_args()
+
+    servers = []
+    for port in args.ports:
+        handler = make_handler(port, args.latency, port in args.fail_ports, args.slow_fraction, args.slow_latency)
+        server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        print(f"Stub model server on http://127.0.0.1:{port}/v1{' (failing)' if port in args.fail_ports else ''}")
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,29 @@
 from io import BytesIO
 import json
 import os
-from openai import OpenAI
+import time
+from concurrent.futures import ThreadPoolExecutor
 import base64
+import contextvars
+import uuid
 import requests
-from pdf2image import convert_from_path
 from dotenv import load_dotenv
-from config import SUMMARY_SYSTEM_PROMPT
+import metrics
+from llm_backend import get_backend, sticky_routing
+from config import (
+    SUMMARY_SYSTEM_PROMPT,
+    TREE_PAGE_SUMMARY_PROMPT,
+    TREE_MERGE_SYSTEM_PROMPT,
+    DELTA_SUMMARY_SYSTEM_PROMPT,
+    DELTA_POLISH_SYSTEM_PROMPT,
+)
 
 load_dotenv()
 
-# This part remains the same
-client = OpenAI(
-        base_url=os.getenv("OPENAI_BASE_URL"),
-        api_key=os.getenv("OPENAI_API_KEY"),  # required, but unused
-    )
-
 
 def pdf_to_base64_images(pdf_path, dpi=300, image_format="png"):
+    from pdf2image import convert_from_path  # pulls in PIL; only needed when rendering
+
     try:
         images = convert_from_path(pdf_path, dpi=dpi)
         base64_images_with_prefix = []
@@ -33,7 +39,37 @@ def pdf_to_base64_images(pdf_path, dpi=300, image_format="png"):
         print(f"Error converting PDF to images: {e}")
         return None
 
-def inference(image_base_64):
+SUMMARY_MODES = ("cumulative", "tree", "delta")
+
+
+def inference(image_base_64, mode=None):
+    """
+    Summarize the document pages with the selected mode.
+
+    mode: "cumulative" (default) rewrites one running summary page by page;
+    "tree" summarizes pages in parallel and merges the results; "delta" keeps
+    key points server-side and only asks each page for changes. Falls back to
+    the SUMMARY_MODE environment variable when not given.
+    """
+    mode = mode or os.getenv("SUMMARY_MODE", "cumulative")
+    if mode not in SUMMARY_MODES:
+        raise ValueError(f"Unknown summary mode: {mode}")
+
+    started = time.perf_counter()
+    # Sequential modes stay on one pool server; tree mode gives each chunk
+    # and merge its own routing key, so they spread across servers
+    with sticky_routing():
+        if mode == "tree":
+            summary = inference_tree(image_base_64)
+        elif mode == "delta":
+            summary = inference_delta(image_base_64)
+        else:
+            summary = inference_cumulative(image_base_64)
+    print(f"Summary mode '{mode}' finished {len(image_base_64 or [])} pages in {time.perf_counter() - started:.2f}s")
+    return summary
+
+
+def inference_cumulative(image_base_64):
     """
     Process each page cumulatively, building upon previous summaries to create
     one final comprehensive summary instead of separate page summaries.
@@ -43,6 +79,7 @@ def inference(image_base_64):
         return "No images provided for summarization."
     
     cumulative_summary = ""
+    output_tokens = 0
     
     # Process each page cumulatively
     for i, image in enumerate(image_base_64):
@@ -68,7 +105,7 @@ Now analyze page {page_num} and update/expand the summary above to include the n
                 ]
             
             # Get response from the model
-            response = client.chat.completions.create(
+            response = get_backend().chat(
                 model=os.getenv("OPENAI_MODEL"),
                 temperature=0.1,
                 messages=[
@@ -76,9 +113,11 @@ Now analyze page {page_num} and update/expand the summary above to include the n
                     {"role": "user", "content": user_content},
                 ],
             )
+            metrics.record_usage(response, "summary")
             
             # Update cumulative summary with the new response
             new_summary = response.choices[0].message.content
+            output_tokens += _completion_tokens(response)
             print(f"New summary: {new_summary}")
             
             if new_summary and new_summary.strip():
@@ -99,7 +138,301 @@ Now analyze page {page_num} and update/expand the summary above to include the n
     if not cumulative_summary:
         cumulative_summary = "No content could be extracted from the document."
     
-    print(f"Final summary length: {len(cumulative_summary)} characters")
+    print(f"Final summary length: {len(cumulative_summary)} characters ({output_tokens} output tokens)")
     return cumulative_summary
 
 
+def _completion_tokens(response):
+    """Output tokens reported by the backend, 0 when usage is not returned"""
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "completion_tokens", None) or 0
+
+
+def _estimate_tokens(text):
+    """Rough token estimate (about 4 characters per token) used for merge budgeting"""
+    return len(text) // 4 + 1
+
+
+def _summarize_chunk(images, first_page, last_page, total_pages):
+    """Map step: summarize a run of consecutive pages on their own"""
+    if first_page == last_page:
+        span = f"page {first_page} of {total_pages}"
+    else:
+        span = f"pages {first_page}-{last_page} of {total_pages}"
+
+    user_content = [{"type": "image_url", "image_url": {"url": image}} for image in images]
+    user_content.append({"type": "text", "text": f"Summarize {span} of this document."})
+
+    try:
+        response = get_backend().chat(
+            model=os.getenv("OPENAI_MODEL"),
+            temperature=0.1,
+            messages=[
+                {"role": "system", "content": TREE_PAGE_SUMMARY_PROMPT},
+                {"role": "user", "content": user_content},
+            ],
+        )
+        metrics.record_usage(response, "summary")
+        summary = (response.choices[0].message.content or "").strip()
+    except Exception as e:
+        print(f"Error summarizing {span}: {e}")
+        summary = ""
+
+    print(f"Summarized {span}: {len(summary)} characters")
+    return summary
+
+
+def _merge_summaries(summaries, final):
+    """Reduce step: merge partial summaries (in document order) into one"""
+    numbered = "\n\n".join(f"Part {i + 1}:\n{summary}" for i, summary in enumerate(summaries))
+    if final:
+        instruction = ("This is the final merge covering the whole document. Structure the result as numbered "
+                       "short paragraphs (e.g., 1., 2., 3.), each 3-4 lines focused on one core idea, and keep "
+                       "it strictly under 250 words.")
+    else:
+        instruction = "Merge these parts into one summary of under 150 words."
+
+    try:
+        response = get_backend().chat(
+            model=os.getenv("OPENAI_MODEL"),
+            temperature=0.1,
+            messages=[
+                {"role": "system", "content": TREE_MERGE_SYSTEM_PROMPT},
+                {"role": "user", "content": f"{numbered}\n\n{instruction}"},
+            ],
+        )
+        metrics.record_usage(response, "summary")
+        merged = (response.choices[0].message.content or "").strip()
+    except Exception as e:
+        print(f"Error merging {len(summaries)} summaries: {e}")
+        merged = ""
+
+    # Never lose content because a merge call failed
+    return merged or "\n".join(summaries)
+
+
+def _group_by_budget(summaries, token_budget):
+    """Split summaries into consecutive groups whose estimated size fits the token budget"""
+    groups = []
+    current = []
+    current_tokens = 0
+    for summary in summaries:
+        tokens = _estimate_tokens(summary)
+        if current and (current_tokens + tokens > token_budget or len(current) >= 8):
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append(summary)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+
+    # A single oversized summary per group would never shrink; force pairs instead
+    if len(groups) == len(summaries) and len(summaries) > 1:
+        groups = [summaries[i:i + 2] for i in range(0, len(summaries), 2)]
+    return groups
+
+
+def _map_in_context(executor, fn, items):
+    """
+    executor.map, but each call runs in a copy of the caller's context so the
+    request's priority class (scheduler.set_priority) applies in the worker
+    threads, and with its own routing key so calls still spread across pool
+    servers. Returns the results in order.
+    """
+    def call(item):
+        with sticky_routing(uuid.uuid4().hex):
+            return fn(item)
+
+    futures = [executor.submit(contextvars.copy_context().run, call, item) for item in items]
+    return [future.result() for future in futures]
+
+
+def inference_tree(image_base_64, pages_per_chunk=None, max_workers=None, token_budget=None):
+    """
+    Hierarchical map-reduce summarization.
+
+    Pages (or chunks of pages) are summarized independently and in parallel,
+    then merged in rounds where each merge call receives at most
+    token_budget estimated tokens of input, until one summary remains.
+    """
+    if not image_base_64:
+        return "No images provided for summarization."
+
+    # A single page gains nothing from a tree
+    if len(image_base_64) == 1:
+        return inference_cumulative(image_base_64)
+
+    pages_per_chunk = pages_per_chunk or int(os.getenv("SUMMARY_PAGES_PER_CHUNK", "1"))
+    max_workers = max_workers or int(os.getenv("SUMMARY_MAX_WORKERS", "4"))
+    token_budget = token_budget or int(os.getenv("SUMMARY_MERGE_TOKEN_BUDGET", "2000"))
+
+    total_pages = len(image_base_64)
+    chunks = [
+        (image_base_64[start:start + pages_per_chunk], start + 1, min(start + pages_per_chunk, total_pages))
+        for start in range(0, total_pages, pages_per_chunk)
+    ]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        summaries = _map_in_context(
+            executor, lambda chunk: _summarize_chunk(chunk[0], chunk[1], chunk[2], total_pages), chunks
+        )
+    return reduce_summaries(summaries, max_workers=max_workers, token_budget=token_budget)
+
+
+def reduce_summaries(summaries, max_workers=None, token_budget=None):
+    """
+    Merge per-page (or per-chunk) summaries, in document order, into the final
+    document summary using budgeted merge rounds.
+    """
+    max_workers = max_workers or int(os.getenv("SUMMARY_MAX_WORKERS", "4"))
+    token_budget = token_budget or int(os.getenv("SUMMARY_MERGE_TOKEN_BUDGET", "2000"))
+
+    summaries = [summary for summary in summaries if summary]
+    if not summaries:
+        return "No content could be extracted from the document."
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        merge_round = 0
+        while True:
+            merge_round += 1
+            groups = _group_by_budget(summaries, token_budget)
+            final = len(groups) == 1
+            print(f"Merge round {merge_round}: {len(summaries)} summaries into {len(groups)}")
+            summaries = _map_in_context(executor, lambda group: _merge_summaries(group, final), groups)
+            if final:
+                break
+
+    final_summary = summaries[0]
+    print(f"Final summary length: {len(final_summary)} characters")
+    return final_summary
+
+
+def _parse_delta(raw_content):
+    """Parse a delta JSON object from the model, tolerating code fences and surrounding text"""
+    content = (raw_content or "").strip()
+    start = content.find("{")
+    end = content.rfind("}")
+    if start == -1 or end <= start:
+        raise ValueError("No JSON object in delta response")
+    delta = json.loads(content[start:end + 1])
+    if not isinstance(delta, dict):
+        raise ValueError("Delta response is not a JSON object")
+    return delta
+
+
+def _apply_delta(points, delta):
+    """Apply add/update/remove operations to the key point list (1-based numbering)"""
+    points = list(points)
+
+    for number, text in (delta.get("update") or {}).items():
+        try:
+            index = int(number) - 1
+        except (TypeError, ValueError):
+            continue
+        if 0 <= index < len(points) and isinstance(text, str) and text.strip():
+            points[index] = text.strip()
+
+    removed = set()
+    for number in delta.get("remove") or []:
+        try:
+            removed.add(int(number) - 1)
+        except (TypeError, ValueError):
+            continue
+    points = [point for i, point in enumerate(points) if i not in removed]
+
+    for text in delta.get("add") or []:
+        if isinstance(text, str) and text.strip() and text.strip() not in points:
+            points.append(text.strip())
+
+    return points
+
+
+def inference_delta(image_base_64):
+    """
+    Incremental summarization: the key point list lives here, each page call
+    returns only additions, updates and removals, and one final call
+    polishes the points into the summary.
+    """
+    if not image_base_64:
+        return "No images provided for summarization."
+
+    points = []
+    output_tokens = 0
+
+    for i, image in enumerate(image_base_64):
+        page_num = i + 1
+        print(f"Processing page {page_num}/{len(image_base_64)} for delta summarization...")
+
+        if points:
+            current = "\n".join(f"{n}. {point}" for n, point in enumerate(points, start=1))
+        else:
+            current = "(none yet)"
+
+        try:
+            response = get_backend().chat(
+                model=os.getenv("OPENAI_MODEL"),
+                temperature=0.1,
+                messages=[
+                    {"role": "system", "content": DELTA_SUMMARY_SYSTEM_PROMPT},
+                    {"role": "user", "content": [
+                        {"type": "text", "text": f"Current key points:\n{current}\n\nChanges for page {page_num} of {len(image_base_64)}:"},
+                        {"type": "image_url", "image_url": {"url": image}},
+                    ]},
+                ],
+            )
+            metrics.record_usage(response, "summary")
+            output_tokens += _completion_tokens(response)
+            delta = _parse_delta(response.choices[0].message.content)
+            points = _apply_delta(points, delta)
+            print(f"Key points after page {page_num}: {len(points)}")
+        except Exception as e:
+            print(f"Error processing page {page_num}: {e}")
+            continue
+
+    if not points:
+        return "No content could be extracted from the document."
+
+    key_points = "\n".join(f"{n}. {point}" for n, point in enumerate(points, start=1))
+    try:
+        response = get_backend().chat(
+            model=os.getenv("OPENAI_MODEL"),
+            temperature=0.1,
+            messages=[
+                {"role": "system", "content": DELTA_POLISH_SYSTEM_PROMPT},
+                {"role": "user", "content": f"Key points from all {len(image_base_64)} pages:\n{key_points}"},
+            ],
+        )
+        metrics.record_usage(response, "summary")
+        output_tokens += _completion_tokens(response)
+        final_summary = (response.choices[0].message.content or "").strip() or key_points
+    except Exception as e:
+        print(f"Error polishing summary: {e}")
+        final_summary = key_points
+
+    print(f"Final summary length: {len(final_summary)} characters ({output_tokens} output tokens)")
+    return final_summary
+
+
+if __name__ == "__main__":
+    # Compare summary modes on a document: python summary.py letter.pdf [mode ...]
+    import sys
+
+    if len(sys.argv) < 2:
+        print("Usage: python summary.py <pdf_path> [mode ...]")
+        sys.exit(1)
+
+    images = pdf_to_base64_images(sys.argv[1])
+    if not images:
+        print("No images could be extracted from the PDF")
+        sys.exit(1)
+
+    timings = {}
+    for mode in sys.argv[2:] or SUMMARY_MODES:
+        started = time.perf_counter()
+        result = inference(images, mode=mode)
+        timings[mode] = time.perf_counter() - started
+        print(f"\n=== {mode} ({timings[mode]:.2f}s) ===\n{result}\n")
+
+    for mode, elapsed in timings.items():
+        print(f"{mode:>12}: {elapsed:8.2f}s for {len(images)} pages ({elapsed / len(images):.2f}s/page)")
@@ -0,0 +1,139 @@
+"""
+Cleanup of temporary PDFs.
+
+The processing endpoints write each request's PDF to the temp directory as
+temp_pdf_*.pdf / temp_summary_*.pdf. /process-pdf-direct keeps its file
+(recorded in the catalog's temp_files table) for a later summarization
+request, and a crashed worker can leave the others behind. The janitor
+sweeps every TEMP_JANITOR_INTERVAL seconds, and once at startup:
+
+- catalogued temp files older than TEMP_TTL_SECONDS are deleted with their record;
+- records whose file is gone are dropped;
+- uncatalogued temp files older than TEMP_ORPHAN_GRACE_SECONDS are deleted
+  (younger ones may belong to a request still in progress);
+- while all temp files together exceed TEMP_QUOTA_MB, catalogued files are
+  evicted oldest first. Nothing reads a kept file back by its temp_id, so
+  age is the only signal of how likely it is to be needed.
+
+The sizes found by the last sweep are reported on /health.
+"""
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from config import logger
+import catalog
+import metrics
+
+TEMP_PREFIXES = ("temp_pdf_", "temp_summary_")
+
+_lock = threading.Lock()
+_stats = {"temp_files": 0, "temp_bytes": 0, "temp_entries": 0, "last_sweep": None}
+
+
+def _scan():
+    """Temp PDFs in the temp directory: {path: (size, mtime)}"""
+    directory = tempfile.gettempdir()
+    files = {}
+    try:
+        entries = os.scandir(directory)
+    except OSError as e:
+        logger.warning(f"Cannot scan temp directory {directory}: {e}")
+        return files
+    with entries:
+        for entry in entries:
+            if not entry.name.startswith(TEMP_PREFIXES) or not entry.name.endswith(".pdf"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # removed by a request meanwhile
+            files[os.path.abspath(entry.path)] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+def _remove(path, reason):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        logger.warning(f"Could not remove temp file {path}: {e}")
+        return False
+    metrics.incr("temp_files_removed_total", reason=reason)
+    return True
+
+
+def sweep(now=None):
+    """Run one cleanup pass; returns the temp file gauges afterwards"""
+    now = now or datetime.now()
+    ttl = timedelta(seconds=float(os.getenv("TEMP_TTL_SECONDS", "3600")))
+    orphan_grace = float(os.getenv("TEMP_ORPHAN_GRACE_SECONDS", "900"))
+    quota_bytes = float(os.getenv("TEMP_QUOTA_MB", "1024")) * 1024 * 1024
+
+    files = _scan()
+    entries = []
+    for entry in catalog.list_temp_files():
+        path = os.path.abspath(entry["temp_path"])
+        if path not in files:
+            if os.path.exists(path):
+                continue  # written after the scan; next sweep
+            catalog.delete_temp_file(entry["temp_id"])
+            metrics.incr("temp_entries_removed_total", reason="missing")
+        elif now - entry["created_at"] > ttl:
+            _remove(path, "expired")
+            files.pop(path)
+            catalog.delete_temp_file(entry["temp_id"])
+            metrics.incr("temp_entries_removed_total", reason="expired")
+        else:
+            entries.append((entry, path))
+
+    catalogued = {path for _, path in entries}
+    for path, (_, mtime) in list(files.items()):
+        if path not in catalogued and now.timestamp() - mtime > orphan_grace:
+            _remove(path, "orphan")
+            files.pop(path)
+
+    total = sum(size for size, _ in files.values())
+    for entry, path in entries:  # oldest first
+        if total <= quota_bytes:
+            break
+        if _remove(path, "quota"):
+            total -= files.pop(path)[0]
+        catalog.delete_temp_file(entry["temp_id"])
+        metrics.incr("temp_entries_removed_total", reason="quota")
+    if total > quota_bytes:
+        logger.warning(f"Temp files use {total / 1024 / 1024:.0f} MB, over TEMP_QUOTA_MB, in requests still running")
+
+    with _lock:
+        _stats.update(
+            temp_files=len(files),
+            temp_bytes=total,
+            temp_entries=catalog.count_temp_files(),
+            last_sweep=now.isoformat(),
+        )
+        return dict(_stats)
+
+
+async def janitor_loop():
+    """Sweep at startup and then every TEMP_JANITOR_INTERVAL seconds"""
+    interval = float(os.getenv("TEMP_JANITOR_INTERVAL", "300"))
+    while True:
+        started = time.perf_counter()
+        try:
+            stats = await asyncio.to_thread(sweep)
+            metrics.observe("temp_janitor_seconds", time.perf_counter() - started)
+            logger.info(f"Temp janitor: {stats['temp_files']} files, {stats['temp_bytes'] / 1024 / 1024:.1f} MB")
+        except Exception as e:
+            logger.warning(f"Temp janitor sweep failed: {e}")
+        if interval <= 0:
+            return
+        await asyncio.sleep(interval)
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,189 @@
+"""
+Streaming, content-addressed storage of uploaded files.
+
+copy_upload() copies an upload to disk in UPLOAD_CHUNK_BYTES chunks and, in
+the same pass, computes its SHA-256, size and PDF page count, so the file
+is never held in memory as a whole. It is blocking; the /upload endpoint
+runs it in a worker thread. Uploads larger than UPLOAD_MAX_MB (default 50)
+are aborted with UploadTooLarge and the partial file is removed.
+
+Uploads are stored once per content: store_upload() puts the file at
+UPLOAD_DIR/blobs/<aa>/<bb>/<sha256> (sharded by the first hash bytes) and
+records a reference-counted blob in the catalog. Uploading content that is
+already stored only adds a document pointing at the existing blob, and
+remove_document() deletes the blob with its last reference. Caches of
+rendered pages or results can key off the same hash.
+
+The page count comes from the page objects (/Type /Page) seen in the file.
+PDFs that keep their page objects in compressed object streams do not show
+them, and get None.
+"""
+import hashlib
+import os
+import re
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+
+import catalog
+
+_PAGE_OBJECT_RE = re.compile(rb"/Type\s*/Page(?![a-zA-Z0-9])")
+_PAGE_OBJECT_OVERLAP = 64  # bytes kept between chunks so a split marker is still found
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_bytes):
+        super().__init__(f"Upload exceeds the maximum size of {max_bytes} bytes")
+        self.max_bytes = max_bytes
+
+
+@dataclass
+class UploadInfo:
+    size: int
+    sha256: str
+    page_count: Optional[int]
+
+
+def max_upload_bytes():
+    return int(float(os.getenv("UPLOAD_MAX_MB", "50")) * 1024 * 1024)
+
+
+class PageCounter:
+    """Counts PDF page objects in a byte stream fed chunk by chunk"""
+
+    def __init__(self):
+        self.pages = 0
+        self._window = b""
+        self._window_start = 0  # stream offset of _window[0]
+        self._counted_until = 0  # stream offset just after the last counted marker
+
+    def _count(self, final):
+        for match in _PAGE_OBJECT_RE.finditer(self._window):
+            end = self._window_start + match.end()
+            # A marker at the very end might still continue ("/Pages"); wait for more data
+            if end <= self._counted_until or (match.end() == len(self._window) and not final):
+                continue
+            self.pages += 1
+            self._counted_until = end
+
+    def feed(self, chunk):
+        self._window += chunk
+        self._count(final=False)
+        keep = min(len(self._window), _PAGE_OBJECT_OVERLAP)
+        self._window_start += len(self._window) - keep
+        self._window = self._window[len(self._window) - keep:]
+
+    def close(self):
+        self._count(final=True)
+        return self.pages or None
+
+
+def copy_upload(source, dest_path, max_bytes=None):
+    """
+    Copy the file object source to dest_path chunk by chunk; returns an
+    UploadInfo. Raises UploadTooLarge (after removing dest_path) when more than
+    max_bytes arrive.
+    """
+    max_bytes = max_upload_bytes() if max_bytes is None else max_bytes
+    chunk_bytes = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+    digest = hashlib.sha256()
+    pages = PageCounter()
+    size = 0
+
+    try:
+        with open(dest_path, "wb") as dest:
+            while True:
+                chunk = source.read(chunk_bytes)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                digest.update(chunk)
+                pages.feed(chunk)
+                dest.write(chunk)
+    except BaseException:
+        try:
+            os.remove(dest_path)
+        except OSError:
+            pass
+        raise
+
+    return UploadInfo(size=size, sha256=digest.hexdigest(), page_count=pages.close())
+
+
+def upload_dir():
+    return os.getenv("UPLOAD_DIR", "uploads")
+
+
+def blob_path(sha256):
+    return os.path.join(upload_dir(), "blobs", sha256[:2], sha256[2:4], sha256)
+
+
+def store_upload(source, doc_id, original_file_name, mime_type, max_bytes=None):
+    """
+    Stream source into the blob store and catalog it as document doc_id.
+    Returns (UploadInfo, blob path, deduplicated); deduplicated is True when
+    the content was already stored and the new copy was dropped.
+    """
+    incoming = os.path.join(upload_dir(), "incoming")
+    os.makedirs(incoming, exist_ok=True)
+    staging_path = os.path.join(incoming, f"{uuid.uuid4().hex}.part")
+    upload = copy_upload(source, staging_path, max_bytes)
+    path = blob_path(upload.sha256)
+
+    try:
+        # The blob file only changes while holding the catalog's write lock,
+        # so a concurrent delete of the last reference cannot remove it under us
+        with catalog.transaction():
+            existing = catalog.add_blob_reference(upload.sha256, upload.size, path)
+            deduplicated = existing and os.path.exists(path)
+            if not deduplicated:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(staging_path, path)
+            try:
+                catalog.add_document(
+                    doc_id=doc_id,
+                    file_name=os.path.basename(original_file_name or "") or f"{doc_id}.pdf",
+                    original_file_name=original_file_name,
+                    mime_type=mime_type,
+                    size=upload.size,
+                    file_path=path,
+                    sha256=upload.sha256,
+                    page_count=upload.page_count,
+                )
+            except BaseException:
+                # The rollback drops the blob record this upload created, so
+                # remove its file too while still holding the write lock (a
+                # restored file of an already recorded blob stays)
+                if not existing:
+                    os.remove(path)
+                raise
+    finally:
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+
+    return upload, path, deduplicated
+
+
+def remove_document(doc_id):
+    """
+    Delete a document; its file goes with the last reference to it. Returns
+    None for an unknown doc_id, else whether the file was removed.
+    """
+    with catalog.transaction():
+        document = catalog.get_document(doc_id)
+        if document is None:
+            return None
+        catalog.delete_document(doc_id)
+        if document["sha256"] and catalog.get_blob(document["sha256"]):
+            remove_file = catalog.release_blob(document["sha256"]) == 0
+        else:
+            # Stored before the blob store: the file belongs to this document alone
+            remove_file = True
+        if remove_file:
+            try:
+                os.remove(document["file_path"])
+            except FileNotFoundError:
+                pass
+    return remove_file
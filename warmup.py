@@ -0,0 +1,106 @@
+"""
+Model warm-up and readiness.
+
+At startup every configured model (OPENAI_MODEL_SMALL, OPENAI_MODEL) is
+loaded on the backend with a minimal request, so the first real request
+does not wait for a cold model load. /ready answers 503 until that has
+succeeded; failed attempts are retried every WARMUP_RETRY_SECONDS.
+WARMUP=off skips warm-up and reports ready immediately.
+
+KEEP_WARM_INTERVAL (seconds, 0 = off) repeats the warm-up whenever no model
+call has been made for that long, so the server does not unload the model
+during quiet periods. With LLM_BACKEND=ollama the warm-up also pins the
+model for OLLAMA_KEEP_ALIVE.
+"""
+import asyncio
+import os
+import threading
+import time
+
+from config import logger
+from llm_backend import get_backend, idle_seconds
+import metrics
+
+_ready = threading.Event()
+_lock = threading.Lock()
+_status = {"state": "starting", "models": {}}
+_last_keep_warm = time.monotonic()
+
+
+def configured_models():
+    models = []
+    for variable in ("OPENAI_MODEL_SMALL", "OPENAI_MODEL"):
+        model = os.getenv(variable)
+        if model and model not in models:
+            models.append(model)
+    return models
+
+
+def warm_up_models():
+    """Send one warm-up request per model; True when every model loaded"""
+    all_loaded = True
+    for model in configured_models():
+        started = time.perf_counter()
+        try:
+            get_backend().warm_up(model)
+        except Exception as e:
+            all_loaded = False
+            logger.warning(f"Warm-up of {model} failed: {e}")
+            with _lock:
+                _status["models"][model] = f"error: {str(e)[:200]}"
+            continue
+
+        elapsed = time.perf_counter() - started
+        metrics.observe("llm_warmup_seconds", elapsed, model=model)
+        logger.info(f"Model {model} warm ({elapsed:.1f}s)")
+        with _lock:
+            _status["models"][model] = "loaded"
+    return all_loaded
+
+
+async def wait_until_ready():
+    """
+    Retry warm-up until every model is loaded, then report ready. Each
+    attempt runs in a worker thread; cancelling the task (on shutdown) stops
+    the retries.
+    """
+    if os.getenv("WARMUP", "on") != "off":
+        with _lock:
+            _status["state"] = "warming"
+        retry_seconds = float(os.getenv("WARMUP_RETRY_SECONDS", "5"))
+        while not await asyncio.to_thread(warm_up_models):
+            await asyncio.sleep(retry_seconds)
+
+    with _lock:
+        _status["state"] = "ready"
+    _ready.set()
+    logger.info("Models ready")
+
+
+def _quiet_seconds():
+    """Seconds since the backend last saw a request: a model call or a keep-warm"""
+    return min(idle_seconds(), time.monotonic() - _last_keep_warm)
+
+
+async def keep_warm_loop():
+    """Re-warm the models whenever the backend has been idle for KEEP_WARM_INTERVAL seconds"""
+    global _last_keep_warm
+    interval = float(os.getenv("KEEP_WARM_INTERVAL", "0"))
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(max(interval - _quiet_seconds(), 1.0))
+        if _ready.is_set() and _quiet_seconds() >= interval:
+            metrics.incr("llm_keep_warm_total")
+            await asyncio.to_thread(warm_up_models)
+            # Warm-ups do not count as model calls for idle_seconds(); wait a full interval from here
+            _last_keep_warm = time.monotonic()
+
+
+def is_ready():
+    return _ready.is_set()
+
+
+def status():
+    with _lock:
+        return {"state": _status["state"], "models": dict(_status["models"])}